@@ -1,28 +1,38 @@
+import asyncio
+import importlib.util
 import logging
 import os
 from sys import platform
 from typing import Optional
 
-import aiofiles as aiofiles
-import pandas as pd
-from fastapi import FastAPI, UploadFile
+import orjson
+from fastapi import FastAPI, UploadFile, Query, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse, Response
 from pydantic import BaseModel
-from starlette.responses import Response
 from starlette.staticfiles import StaticFiles
 
 from panoptic import core
-from panoptic.compute.similarity import get_similar_images_from_text
+from panoptic.compute.similarity import get_similar_images_from_text, reset_similarity_tree
 from panoptic.core import create_property, create_tag, \
     update_tag, get_tags, get_properties, delete_property, update_property, delete_tag, delete_tag_parent, add_folder, \
-    db_utils, make_clusters, get_similar_images, read_properties_file, get_full_images, set_property_values, \
-    export_properties
-from panoptic.core import db
+    db_utils, make_clusters, get_similar_images, get_full_images, set_property_values, \
+    export_properties, sync_folder, get_images_page, iter_full_images, get_tag_counts, get_images_with_tags, \
+    get_tag_descendants, import_properties_file, properties_file_progress
+from panoptic.core import db, export, thumbnails
+from panoptic.responses import ImageFileResponse, ImageBytesResponse, IMMUTABLE, REVALIDATE
 from panoptic.models import Property, Tag, Properties, PropertyPayload, \
     SetPropertyValuePayload, AddTagPayload, DeleteImagePropertyPayload, \
     UpdateTagPayload, UpdatePropertyPayload, Tab, MakeClusterPayload, GetSimilarImagesPayload, \
-    ChangeProjectPayload, Clusters, GetSimilarImagesFromTextPayload, ExportPropertiesPayload
+    ChangeProjectPayload, Clusters, GetSimilarImagesFromTextPayload, ExportPropertiesPayload, GetThumbnailsPayload
+
+# nombre de lignes du csv de propriétés lues et écrites à la fois
+CSV_CHUNK_SIZE = int(os.getenv('PANOPTIC_CSV_CHUNK_SIZE', 50000))
+# secondes pendant lesquelles les changements de l'import sont regroupés dans un seul évènement
+IMPORT_EVENTS_INTERVAL = 0.25
+IMPORT_EVENTS_KEEPALIVE = 15
+# nombre d'images lues à la fois quand elles sont renvoyées par pages ou en flux
+IMAGES_PAGE_SIZE = 1000
 
 app = FastAPI()
 app.add_middleware(
@@ -58,21 +68,39 @@ async def update_property_route(payload: UpdatePropertyPayload) -> Property:
     return await update_property(payload)
 
 
+# upload_id, choisi par le client, permet de suivre l'import avec /property/file/progress pendant qu'il a lieu
 @app.post('/property/file')
-async def properties_by_file(file: UploadFile):
-    data = pd.read_csv(file.file, sep=";")
-    return await read_properties_file(data)
+async def properties_by_file(file: UploadFile, chunk_size: int = Query(CSV_CHUNK_SIZE, ge=1),
+                             upload_id: Optional[str] = None):
+    return await import_properties_file(file.file, chunk_size, upload_id)
+
+
+@app.get('/property/file/progress')
+async def properties_file_progress_route(upload_id: str):
+    if upload_id not in properties_file_progress:
+        raise HTTPException(status_code=404, detail="Unknown upload")
+    return properties_file_progress[upload_id]
 
 
 @app.post('/export')
-async def export_properties_route(payload: ExportPropertiesPayload) -> StreamingResponse:
-    stream = await export_properties(payload.images, payload.properties)
-    response = StreamingResponse(iter([stream.getvalue()]),
-                                 media_type="text/csv"
-                                 )
-    response.headers["Content-Disposition"] = "attachment; filename=export.csv"
+async def export_properties_route(payload: ExportPropertiesPayload, format: str = 'csv') -> StreamingResponse:
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown export format {format}")
+    if format == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        raise HTTPException(status_code=400, detail="Parquet export needs pyarrow to be installed")
+    columns, types, pages = await export_properties(payload.images, payload.properties)
+    if format == 'parquet':
+        stream = export.to_parquet(columns, types, pages)
+    else:
+        stream = export.to_csv(columns, pages)
+    if format == 'csv.gz':
+        stream = export.to_gzip(stream)
+    media_type, filename = export.FORMATS[format]
+    response = StreamingResponse(stream, media_type=media_type)
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
     return response
 
+
 @app.delete('/property/{property_id}')
 async def delete_property_route(property_id: str):
     await delete_property(property_id)
@@ -80,25 +108,51 @@ async def delete_property_route(property_id: str):
 
 
 # Route pour récupérer la liste de toutes les images
+# sans limit ni after toutes les images sont renvoyées, sinon par pages (de IMAGES_PAGE_SIZE images sans limit)
+# et la page suivante est obtenue avec after=X-Next-Cursor
+# format=ndjson renvoie les images en flux, une par ligne, au fur et à mesure de leur lecture
 @app.get("/images", response_class=ORJSONResponse)
-async def get_images_route():
-    images = await get_full_images()
-    return ORJSONResponse(images)
+async def get_images_route(after: int = 0, limit: Optional[int] = Query(None, ge=1), properties: bool = True,
+                           ahash: bool = True, format: str = 'json'):
+    if format not in ('json', 'ndjson'):
+        raise HTTPException(status_code=400, detail=f"Unknown format {format}")
+    if format == 'ndjson':
+        return StreamingResponse(_stream_images(after, limit, properties, ahash), media_type='application/x-ndjson')
+    if limit is None and after == 0 and properties and ahash:
+        images = await get_full_images()
+        return ORJSONResponse(images)
+    page_size = limit or IMAGES_PAGE_SIZE
+    images = await get_images_page(after, page_size, properties, ahash)
+    response = ORJSONResponse(images)
+    if len(images) == page_size:
+        response.headers['X-Next-Cursor'] = str(images[-1].id)
+    return response
+
+
+async def _stream_images(after: int, limit: int | None, properties: bool, ahash: bool):
+    remaining = limit
+    page_size = min(limit, IMAGES_PAGE_SIZE) if limit else IMAGES_PAGE_SIZE
+    async for images in iter_full_images(page_size, properties, ahash, after):
+        if remaining is not None:
+            images = images[:remaining]
+            remaining -= len(images)
+        yield b''.join(orjson.dumps(img, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY) + b'\n'
+                       for img in images)
+        if remaining == 0:
+            return
 
 
 @app.get('/images/{file_path:path}')
 async def get_image(file_path: str):
+    url = '/images/' + file_path
     if platform == "linux" or platform == "linux2" or platform == "darwin":
         if not file_path.startswith('/'):
             file_path = '/' + file_path
-    # print(file_path)
-    async with aiofiles.open(file_path, 'rb') as f:
-        data = await f.read()
-
+    # the url stored at import is the one requested, its sha1 is part of the ETag of the file
+    sha1 = await db.get_sha1_by_url(url)
     ext = file_path.split('.')[-1]
-
-    # # media_type here sets the media type of the actual response sent to the client.
-    return Response(content=data, media_type="image/" + ext)
+    # the original can be modified on disk, it is never immutable
+    return ImageFileResponse(file_path, sha1=sha1, cache_control=REVALIDATE, media_type="image/" + ext)
 
 
 # Route pour ajouter une property à une image dans la table de jointure entre image et property
@@ -128,6 +182,21 @@ async def get_tags_route(property: Optional[str] = None):
     tags = await get_tags(property)
     return ORJSONResponse(tags)
 
+@app.get("/tags/count")
+async def get_tag_counts_route(property: Optional[int] = None) -> dict[int, int]:
+    return await get_tag_counts(property)
+
+
+@app.get("/tags/images")
+async def get_images_with_tags_route(tag_id: list[int] = Query(), with_descendants: bool = False) -> list[int]:
+    return await get_images_with_tags(tag_id, with_descendants)
+
+
+@app.get("/tags/descendants")
+async def get_tag_descendants_route(tag_id: int) -> list[int]:
+    return await get_tag_descendants(tag_id)
+
+
 @app.patch("/tags")
 async def update_tag_route(payload: UpdateTagPayload) -> Tag:
     return await update_tag(payload)
@@ -168,6 +237,53 @@ async def get_import_status_route():
     return res
 
 
+# Flux Server-Sent Events de l'avancement de l'import, remplace les appels répétés à /import_status.
+# Les changements sont regroupés pendant IMPORT_EVENTS_INTERVAL secondes avant d'être envoyés
+@app.get('/import_events')
+async def get_import_events_route():
+    return StreamingResponse(_import_events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def _import_events():
+    image_import = core.importer
+    subscriber = image_import.events.subscribe()
+    try:
+        # the current state is sent first so that the client doesn't wait for the next change
+        yield _import_event(image_import, [], False)
+        while True:
+            if not await subscriber.wait(IMPORT_EVENTS_KEEPALIVE):
+                # comment lines keep proxies from closing an idle connection
+                yield b': keepalive\n\n'
+                continue
+            await asyncio.sleep(IMPORT_EVENTS_INTERVAL)
+            new_images, index_rebuilt = subscriber.drain()
+            if not new_images:
+                yield _import_event(image_import, [], index_rebuilt)
+            for start in range(0, len(new_images), IMAGES_PAGE_SIZE):
+                images = await get_full_images(new_images[start:start + IMAGES_PAGE_SIZE])
+                yield _import_event(image_import, images, index_rebuilt)
+    finally:
+        image_import.events.unsubscribe(subscriber)
+
+
+def _import_event(image_import, new_images: list, index_rebuilt: bool) -> bytes:
+    status = {
+        'to_import': image_import.total_import,
+        'imported': image_import.current_import,
+        'computed': image_import.current_computed,
+        'index_rebuilt': index_rebuilt,
+        'new_images': new_images
+    }
+    data = orjson.dumps(status, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return b'event: import\ndata: ' + data + b'\n\n'
+
+
+@app.get('/workers')
+async def get_workers_route():
+    return core.importer.get_worker_stats()
+
+
 class PathRequest(BaseModel):
     path: str
 
@@ -179,6 +295,11 @@ async def add_folder_route(path: PathRequest):
     return await get_folders_route()
 
 
+@app.post("/folders/sync")
+async def sync_folder_route(path: PathRequest) -> dict[str, int]:
+    return await sync_folder(path.path)
+
+
 @app.get("/tabs")
 async def get_tabs_route():
     return await db.get_tabs()
@@ -221,19 +342,38 @@ async def get_similar_images_from_text_route(payload: GetSimilarImagesFromTextPa
 async def change_project_route(payload: ChangeProjectPayload):
     os.environ['PANOPTIC_DATA'] = payload.project
     await db_utils.init()
+    reset_similarity_tree()
     return f"changed project to {payload.project}"
 
 
+# avec width la miniature est la plus petite taille de la pyramide au moins aussi large, faite à la demande si besoin
 @app.get('/small/images/{file_path:path}')
-async def get_image(file_path: str):
+async def get_image(file_path: str, width: Optional[int] = None):
+    sha1, ext = os.path.splitext(os.path.basename(file_path))
+    if width is not None:
+        data, size = await thumbnails.get_thumbnail(sha1, width)
+        if data is None:
+            raise HTTPException(status_code=404, detail="Thumbnail not found")
+        # a smaller thumbnail served in place of the one asked is replaced once the asked one can be made
+        if size == thumbnails.pick_tier(width):
+            return ImageBytesResponse(data, f'{sha1}-{size}', media_type=thumbnails.media_type(data))
+        return ImageBytesResponse(data, f'{sha1}-{size}' if size else sha1, cache_control=REVALIDATE,
+                                  media_type=thumbnails.media_type(data))
+    data = thumbnails.get_store().get(sha1) or thumbnails.get_tier_store(thumbnails.GRID_TIER).get(sha1)
+    if data is not None:
+        return ImageBytesResponse(data, sha1, media_type=thumbnails.media_type(data))
+    # projects whose mini folder wasn't packed yet
     path = os.path.join(os.environ['PANOPTIC_DATA'], 'mini', file_path)
-    async with aiofiles.open(path, 'rb') as f:
-        data = await f.read()
+    return ImageFileResponse(path, sha1=sha1, cache_control=IMMUTABLE, media_type="image/" + ext[1:])
 
-    ext = path.split('.')[-1]
 
-    # # media_type here sets the media type of the actual response sent to the client.
-    return Response(content=data, media_type="image/" + ext)
+# Route pour récupérer plusieurs miniatures en une seule réponse, voir core.thumbnails.to_bundle pour le format
+@app.post('/small/images')
+async def get_thumbnails_route(payload: GetThumbnailsPayload):
+    if len(payload.sha1s) > thumbnails.MAX_BUNDLE:
+        raise HTTPException(status_code=400, detail=f"At most {thumbnails.MAX_BUNDLE} thumbnails by request")
+    minis = await asyncio.to_thread(thumbnails.read_minis, payload.sha1s)
+    return Response(content=thumbnails.to_bundle(payload.sha1s, minis), media_type='application/octet-stream')
 
 
 # app.mount("/small/images/", StaticFiles(directory=os.path.join('PANOPTIC_DATA', 'mini')), name="static")
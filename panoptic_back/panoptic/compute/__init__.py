@@ -1,2 +1,2 @@
-from .transform import to_average_hash, to_sha1, to_vector, can_compute_pca, create_pca, to_pca
+from .transform import to_average_hash, to_sha1, to_vector, to_vectors, to_model_input, can_compute_pca, create_pca, to_pca
 from .similarity import make_clusters, get_similar_images, create_similarity_tree
\ No newline at end of file
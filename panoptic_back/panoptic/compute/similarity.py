@@ -1,3 +1,4 @@
+import json
 import math
 import os
 import pickle
@@ -9,7 +10,7 @@ from faiss import index_factory
 from sklearn.cluster import DBSCAN, KMeans, estimate_bandwidth, MeanShift
 from sklearn.neighbors import KDTree
 
-from panoptic.compute.transform import transformer
+from panoptic.compute.transform import load_transformer
 from panoptic.compute.utils import load_similarity_tree
 from panoptic.models import ComputedValue
 
@@ -27,34 +28,202 @@ class SimilarityTreeWithLabel:
 
 
 class SimilarityFaissWithLabel:
-    def __init__(self, images: list[ComputedValue]):
-        vectors, sha1_list = zip(*[(i.vector, i.sha1) for i in images])
-        vectors = np.asarray(vectors)
+    """
+    Faiss index of the image vectors. Each vector is stored with the id of its computed value so that
+    new images can be added and removed ones deleted without rebuilding the whole index.
+    The sha1 of each id is kept in two aligned arrays sorted by id
+    """
+    # reduce vector size only if we have more than 100k images otherwise it's not worth it since we lose accuracy
+    IVF_THRESHOLD = 100000
+    # the IVF quantizer is trained again once the index doubled in size or a quarter of the vectors it was
+    # trained with were removed
+    MAX_GROWTH = 2
+    MAX_REMOVED = 0.25
+
+    INDEX_FILE = 'tree_faiss.index'
+    LABELS_FILE = 'tree_faiss_labels.npy'
+    INFO_FILE = 'tree_faiss.json'
+    LABEL_DTYPE = np.dtype([('id', '<i8'), ('sha1', 'S40')])
+
+    def __init__(self, index, labels: np.ndarray, trained_size=0, removed_since_training=0, updatable=True):
+        self.tree = index
+        self.labels = labels
+        self.trained_size = trained_size
+        self.removed_since_training = removed_since_training
+        # indexes loaded from an old pickle have positions instead of stable ids
+        self.updatable = updatable
+
+    @classmethod
+    def from_vectors(cls, ids: list[int], sha1s: list[str], vectors: np.ndarray):
+        """
+        ids must be sorted, vectors are normalized in place
+        """
+        vectors = np.ascontiguousarray(vectors, dtype='float32')
         faiss.normalize_L2(vectors)
-        self.image_labels = sha1_list
+        labels = np.array(list(zip(ids, sha1s)), dtype=cls.LABEL_DTYPE)
         # create the faiss index based on this post: https://anttihavanko.medium.com/building-image-search-with-openai-clip-5a1deaa7a6e2
         nb_vectors = vectors.shape[0]
         vector_size = vectors.shape[1]
-        # reduce vector size only if we have more than 100k images otherwise it's not worth it since we lose accuracy
-        if nb_vectors < 100000:
-            index = faiss.IndexFlatIP(vector_size)
+        trained_size = 0
+        if nb_vectors < cls.IVF_THRESHOLD:
+            index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector_size))
         else:
             cells = min(round(math.sqrt(nb_vectors)), int(nb_vectors / 39))
             index = index_factory(vector_size, f"IVF{cells},PQ16np")
             index.train(vectors)
             index.nprobe = 10
-        self.tree = index
-        self.tree.add(np.asarray(vectors))
+            trained_size = nb_vectors
+        index.add_with_ids(vectors, labels['id'])
+        return cls(index, labels, trained_size)
+
+    def save(self, folder: str):
+        # files are replaced only once fully written since other processes may have mapped the previous ones
+        _replace_file(os.path.join(folder, self.INDEX_FILE), lambda path: faiss.write_index(self.tree, path))
+        _replace_file(os.path.join(folder, self.LABELS_FILE), lambda path: _write_array(path, self.labels))
+        info = {'trained_size': self.trained_size, 'removed_since_training': self.removed_since_training}
+        _replace_file(os.path.join(folder, self.INFO_FILE), lambda path: _write_json(path, info))
+
+    @classmethod
+    def load(cls, folder: str, mmap=True):
+        """
+        With mmap the index and labels are mapped read only from their files instead of being copied in memory,
+        which makes loading immediate and lets several processes share them
+        """
+        index_path = os.path.join(folder, cls.INDEX_FILE)
+        if not os.path.exists(index_path):
+            return None
+        with open(os.path.join(folder, cls.INFO_FILE), 'r') as f:
+            info = json.load(f)
+        if mmap:
+            # inverted lists of IVF indexes and codes of flat indexes are mapped with different flags
+            # that can't be combined
+            if info['trained_size'] > 0:
+                flags = faiss.IO_FLAG_MMAP
+            else:
+                flags = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+            index = faiss.read_index(index_path, flags | faiss.IO_FLAG_READ_ONLY)
+        else:
+            index = faiss.read_index(index_path)
+        if isinstance(index, faiss.IndexIVF):
+            index.nprobe = 10
+        labels = np.load(os.path.join(folder, cls.LABELS_FILE), mmap_mode='r' if mmap else None)
+        tree = cls(index, labels, info['trained_size'], info['removed_since_training'])
+        tree.read_only = mmap
+        return tree
+
+    @classmethod
+    def from_legacy(cls, legacy):
+        """
+        Convert an index unpickled from tree_faiss.pkl: its vectors are identified by their position
+        """
+        sha1s = legacy.__dict__['image_labels']
+        labels = np.array(list(enumerate(sha1s)), dtype=cls.LABEL_DTYPE)
+        return cls(legacy.__dict__['tree'], labels, updatable=False)
+
+    read_only = False
+
+    @property
+    def is_trained_index(self):
+        return self.trained_size > 0
+
+    def contains(self, ids: list[int]) -> list[int]:
+        ids = np.asarray(ids, dtype='int64')
+        return ids[np.isin(ids, self.labels['id'])].tolist()
+
+    def diff(self, ids: list[int]) -> tuple[np.ndarray, list[int]]:
+        """
+        Compare the index with the ids it should contain: mask of the ids missing from the index
+        and ids of the index that aren't in ids anymore
+        """
+        ids = np.asarray(ids, dtype='int64')
+        missing = ~np.isin(ids, self.labels['id'])
+        extra = self.labels['id'][~np.isin(self.labels['id'], ids)]
+        return missing, extra.tolist()
+
+    def needs_rebuild(self, nb_added: int, nb_removed: int) -> bool:
+        """
+        Whether adding and removing this many vectors requires to build the index again from scratch
+        """
+        total = len(self.labels) + nb_added - nb_removed
+        if not self.is_trained_index:
+            return total >= self.IVF_THRESHOLD
+        if total > self.trained_size * self.MAX_GROWTH:
+            return True
+        return self.removed_since_training + nb_removed > self.trained_size * self.MAX_REMOVED
+
+    def add(self, ids: list[int], sha1s: list[str], vectors: np.ndarray):
+        """
+        ids must not be in the index yet
+        """
+        if not len(ids):
+            return
+        vectors = np.ascontiguousarray(vectors, dtype='float32')
+        faiss.normalize_L2(vectors)
+        labels = np.array(list(zip(ids, sha1s)), dtype=self.LABEL_DTYPE)
+        self.tree.add_with_ids(vectors, labels['id'])
+        # images restored after being removed come back with their old id, labels are sorted again
+        self.labels = np.sort(np.concatenate([self.labels, labels]), order='id')
+
+    def remove(self, ids: list[int]):
+        ids = self.contains(ids)
+        if not ids:
+            return
+        self.tree.remove_ids(np.asarray(ids, dtype='int64'))
+        self.labels = self.labels[~np.isin(self.labels['id'], ids)]
+        self.removed_since_training += len(ids)
 
     def query(self, image: np.ndarray, k=500):
         faiss.normalize_L2(image)
         vector = image.reshape(1, -1)
         dist, ind = self.tree.search(vector, k) # len(self.image_labels))
-        indices = [x for x in ind[0]]
-        distances = [x for x in dist[0]]
-        return [{'sha1': self.image_labels[i], 'dist': float('%.2f' % (distances[index]))} for index, i in enumerate(indices)]
+        # faiss returns -1 ids when the index has less than k vectors
+        found = ind[0] >= 0
+        positions = np.searchsorted(self.labels['id'], ind[0][found])
+        sha1s = self.labels['sha1'][positions]
+        return [{'sha1': sha1.decode(), 'dist': float('%.2f' % d)} for sha1, d in zip(sha1s, dist[0][found])]
+
+
+def _replace_file(path: str, write):
+    tmp_path = path + '.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _write_array(path: str, array: np.ndarray):
+    # np.save would add a .npy extension to the temporary path
+    with open(path, 'wb') as f:
+        np.save(f, array)
+
+
+def _write_json(path: str, data: dict):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+SIMILARITY_TREE: SimilarityFaissWithLabel | SimilarityTreeWithLabel | None = None
+
+
+def get_similarity_tree():
+    """
+    The similarity index is loaded on first use
+    """
+    global SIMILARITY_TREE
+    if SIMILARITY_TREE is None:
+        SIMILARITY_TREE = SimilarityFaissWithLabel.load(os.getenv('PANOPTIC_DATA'))
+    if SIMILARITY_TREE is None:
+        legacy = load_similarity_tree()
+        if legacy is not None:
+            SIMILARITY_TREE = SimilarityFaissWithLabel.from_legacy(legacy)
+    return SIMILARITY_TREE
+
+
+def reset_similarity_tree():
+    """
+    Forget the loaded index, the one of the current project will be loaded on next use
+    """
+    global SIMILARITY_TREE
+    SIMILARITY_TREE = None
 
-SIMILARITY_TREE: SimilarityTreeWithLabel = load_similarity_tree()
 
 def create_similarity_tree(images: list[ComputedValue]):
     tree = SimilarityTreeWithLabel(images)
@@ -64,33 +233,57 @@ def create_similarity_tree(images: list[ComputedValue]):
     SIMILARITY_TREE = tree
 
 
-def create_similarity_tree_faiss(images: list[ComputedValue]):
-    tree = SimilarityFaissWithLabel(images)
-    with open(os.path.join(os.getenv('PANOPTIC_DATA'), 'tree_faiss.pkl'), 'wb') as f:
-        pickle.dump(tree, f)
+def create_similarity_tree_faiss(ids: list[int], sha1s: list[str], vectors: np.ndarray):
+    tree = SimilarityFaissWithLabel.from_vectors(ids, sha1s, vectors)
+    save_similarity_tree_faiss(tree)
+
+
+def update_similarity_tree_faiss(tree: SimilarityFaissWithLabel, ids: list[int], sha1s: list[str], vectors: np.ndarray,
+                                 removed_ids: list[int]):
+    tree.add(ids, sha1s, vectors)
+    tree.remove(removed_ids)
+    save_similarity_tree_faiss(tree)
+
+
+def save_similarity_tree_faiss(tree: SimilarityFaissWithLabel):
+    tree.save(os.getenv('PANOPTIC_DATA'))
     global SIMILARITY_TREE
     SIMILARITY_TREE = tree
 
 
+def get_similarity_tree_faiss() -> SimilarityFaissWithLabel | None:
+    """
+    Faiss index that can be updated incrementally, None if the index wasn't computed yet or was saved
+    by an older version without stable ids.
+    A memory mapped index is read only, a writable copy is loaded from its files
+    """
+    tree = get_similarity_tree()
+    if not isinstance(tree, SimilarityFaissWithLabel) or not tree.updatable:
+        return None
+    if tree.read_only:
+        return SimilarityFaissWithLabel.load(os.getenv('PANOPTIC_DATA'), mmap=False)
+    return tree
+
+
 async def get_similar_images_from_text(input_text: str):
+    transformer = load_transformer()
     if transformer.can_handle_text:
         vec = transformer.to_text_vector(input_text)
-        return SIMILARITY_TREE.query(vec)
+        return get_similarity_tree().query(vec)
 
 
-def get_similar_images(vectors: list[np.ndarray]):
-    if not SIMILARITY_TREE:
+def get_similar_images(vectors: np.ndarray):
+    tree = get_similarity_tree()
+    if not tree:
         raise ValueError("Cannot compute image similarity since KDTree was not computed yet")
     vector = np.mean(vectors, axis=0)
-    return SIMILARITY_TREE.query(np.asarray([vector]))
+    return tree.query(np.asarray([vector]))
 
 
-def make_clusters(images: list[ComputedValue], *, method='kmeans', **kwargs) -> (list[list[str]], list[int]):
+def make_clusters(sha1s: list[str], vectors: np.ndarray, *, method='kmeans', **kwargs) -> (list[list[str]], list[int]):
     res_clusters = []
     res_distances = []
-    vectors, sha1, ahashs = zip(*[(i.vector, i.sha1, i.ahash) for i in images])
-    sha1 = np.asarray(sha1)
-    ahashs = np.asarray(ahashs)
+    sha1 = np.asarray(sha1s)
     clusters: np.ndarray
     distances: np.ndarray | None = None
     method = "faiss"
@@ -107,7 +300,6 @@ def make_clusters(images: list[ComputedValue], *, method='kmeans', **kwargs) ->
             return [[]]
     for cluster in list(set(clusters)):
         sha1_clusters = sha1[clusters == cluster]
-        ahashs_clusters = ahashs[clusters == cluster]
         # sort by average_hash
         # sorted_cluster = [sha1 for _, sha1 in sorted(zip(ahashs_clusters, sha1_clusters))]
         if distances is not None:
@@ -131,7 +323,7 @@ def _make_clusters_kmeans(vectors, nb_clusters=6, *args, **kwargs) -> np.ndarray
 
 
 def _make_clusters_faiss(vectors, nb_clusters=6, *args, **kwargs) -> (np.ndarray, np.ndarray):
-    vectors = np.asarray(vectors)
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
     kmean = faiss.Kmeans(vectors.shape[1], nb_clusters, niter=20, verbose=False)
     kmean.train(vectors)
     distances, indices = kmean.index.search(vectors, 1)
@@ -2,20 +2,24 @@
 
 import os
 import pickle
+import threading
 
 import numpy as np
 from imagehash import average_hash
 from hashlib import sha1 as sha1hash
-from PIL import Image
+from PIL import Image, ImageOps
 from sklearn.decomposition import PCA
 from sklearn.neighbors import KDTree
-from .transformers import get_transformer
 
 
 PCA_SIZE = 10
+# images are resized and center cropped to this size before being sent to the model
+MODEL_INPUT_SIZE = 224
 USE_PCA_IF_POSSIBLE = True
 
-transformer = get_transformer("clip")
+# the transformer is loaded on first use so that processes that never vectorize images don't import torch
+transformer = None
+_transformer_lock = threading.Lock()
 
 pca: None | PCA = None
 tree: None | KDTree = None
@@ -25,14 +29,41 @@ def to_sha1(image: Image) -> str:
     return sha1hash(image.tobytes()).hexdigest()
 
 
+def load_transformer():
+    global transformer
+    if transformer is None:
+        # workers of a thread pool load it at the same time, only the first one loads it
+        with _transformer_lock:
+            if transformer is None:
+                from .transformers import get_transformer
+                transformer = get_transformer("clip")
+    return transformer
+
+
 def to_vector(image: Image):
-    vec = transformer.to_vector(image)
+    vec = load_transformer().to_vector(image)
     # if a pca was already trained use it
     if get_pca() is not None:
         return to_pca(vec)
     return vec
 
 
+def to_vectors(images: list[Image]) -> np.ndarray:
+    vectors = load_transformer().to_vectors(images)
+    if get_pca() is not None:
+        return np.float32(pca.transform(vectors))
+    return vectors
+
+
+def to_model_input(image: Image) -> np.ndarray:
+    """
+    Resize and center crop the image the same way the model processor does, so that the
+    decoded file doesn't need to be kept or opened again to compute its vector
+    """
+    resized = ImageOps.fit(image, (MODEL_INPUT_SIZE, MODEL_INPUT_SIZE), Image.BICUBIC)
+    return np.asarray(resized, dtype=np.uint8)
+
+
 def to_average_hash(image: Image):
     ahash = average_hash(image)
     return ahash
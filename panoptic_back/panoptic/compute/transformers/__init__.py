@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 from PIL import Image
 from transformers import MobileNetV2Model, AutoImageProcessor, CLIPModel, CLIPProcessor, CLIPTokenizer, logging
 
@@ -21,6 +22,12 @@ class GoogleTransformer:
         vector = pooled_output1.flatten()
         return vector
 
+    def to_vectors(self, images: list[Image]) -> np.ndarray:
+        inputs = self.processor(images=images, return_tensors="pt")
+        with torch.no_grad():
+            outputs = self.model(**inputs)
+        return outputs[1].cpu().numpy().reshape(len(images), -1)
+
 
 class CLIPTransformer:
     def __init__(self):
@@ -43,6 +50,19 @@ class CLIPTransformer:
         embedding_as_np = embedding.cpu().detach().numpy()
         return embedding_as_np[0]
 
+    def to_vectors(self, images: list[Image]) -> np.ndarray:
+        """
+        Same as to_vector but runs a single forward pass for the whole batch
+        """
+        pixel_values = self.processor(
+            text=None,
+            images=images,
+            return_tensors="pt"
+        )["pixel_values"]
+        with torch.no_grad():
+            embeddings = self.model.get_image_features(pixel_values)
+        return embeddings.cpu().numpy()
+
     def to_text_vector(self, text: str) -> np.ndarray:
         inputs = self.tokenizer(text, return_tensors="pt")
         text_embeddings = self.model.get_text_features(**inputs)
@@ -0,0 +1,81 @@
+import logging
+import os
+import sys
+import threading
+import time
+
+from PIL import Image
+
+from panoptic.compute.transform import load_transformer, to_vectors, to_average_hash
+
+logger = logging.getLogger('EmbeddingWorker')
+
+_model_load_time: float | None = None
+
+
+def init_worker():
+    """
+    Initializer of the embedding pool: load the model once per worker instead of once per task
+    """
+    global _model_load_time
+    start = time.perf_counter()
+    load_transformer()
+    _model_load_time = time.perf_counter() - start
+    stats = get_worker_stats()
+    logger.info(f"worker {stats['worker']} loaded model in {stats['model_load_time']:.2f}s, "
+                f"memory: {stats['memory']} MB")
+
+
+def compute_vectors(pixels: list):
+    return to_vectors(pixels), get_worker_stats()
+
+
+def compute_images(image_paths: list[str]):
+    """
+    Vectors and average hashes of images read from their file, None for the files that can't be opened
+    """
+    ahashs = [None] * len(image_paths)
+    vectors = [None] * len(image_paths)
+    images = []
+    valid = []
+    for i, path in enumerate(image_paths):
+        try:
+            image = Image.open(path)
+            images.append(image.convert('RGB'))
+            valid.append(i)
+        except Exception as e:
+            logger.error(f'could not open {path}: {e}')
+    if not images:
+        return ahashs, vectors, get_worker_stats()
+
+    batch_vectors = to_vectors(images)
+    for i, image, vector in zip(valid, images, batch_vectors):
+        ahashs[i] = str(to_average_hash(image))
+        vectors[i] = vector
+
+    del images
+    return ahashs, vectors, get_worker_stats()
+
+
+def get_worker_stats() -> dict:
+    return {
+        'worker': f'{os.getpid()}-{threading.get_ident()}',
+        'pid': os.getpid(),
+        'model_load_time': _model_load_time,
+        'memory': _get_memory_usage()
+    }
+
+
+def _get_memory_usage() -> float | None:
+    """
+    Peak resident memory of the current process in MB, None if the platform doesn't expose it
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on linux
+    if sys.platform == 'darwin':
+        return round(max_rss / 1024 / 1024, 1)
+    return round(max_rss / 1024, 1)
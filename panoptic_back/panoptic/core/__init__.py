@@ -1,27 +1,42 @@
+import asyncio
 import atexit
-import io
 import json
 import logging
+import math
+import multiprocessing
 import os
 import random
+import uuid
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
-from typing import List, Any
+from typing import List, Any, AsyncIterator
 
 import pandas
 import pandas as pd
 from fastapi import HTTPException
-from tqdm import tqdm
 
 from panoptic import compute
+from panoptic.compute.worker import init_worker
 from panoptic.core import db
+from panoptic.core.db_utils import transaction
 from panoptic.models import PropertyType, JSON, Tag, Property, Tags, Properties, \
     UpdateTagPayload, UpdatePropertyPayload, Image, PropertyValue, Clusters
 from .image_importer import ImageImporter
+from .tag_graph import get_tag_graph
 
 nb_workers = 4
-executor = ThreadPoolExecutor(max_workers=nb_workers) if os.getenv('IS_DOCKER', False) else ProcessPoolExecutor(max_workers=nb_workers)
+# each embedding worker holds its own copy of the model in memory
+nb_embedding_workers = int(os.getenv('PANOPTIC_EMBEDDING_WORKERS', 2))
+# number of images sent together to the vectorization model
+batch_size = int(os.getenv('PANOPTIC_BATCH_SIZE', 32))
+executor = ThreadPoolExecutor(max_workers=nb_workers) if os.getenv('IS_DOCKER', False) \
+    else ProcessPoolExecutor(max_workers=nb_workers)
+# the model always runs in worker processes, even in docker, so that the API process never imports torch.
+# They are spawned: a fresh interpreter only imports panoptic.compute, not the state of the API process
+embedding_executor = ProcessPoolExecutor(max_workers=nb_embedding_workers, initializer=init_worker,
+                                         mp_context=multiprocessing.get_context('spawn'))
 atexit.register(executor.shutdown)
-importer = ImageImporter(executor)
+atexit.register(embedding_executor.shutdown)
+importer = ImageImporter(executor, embedding_executor, batch_size=batch_size)
 
 
 async def create_property(name: str, property_type: PropertyType, mode='id') -> Property:
@@ -104,42 +119,40 @@ async def add_property_values(property_id: int, value: Any, image_ids: List[int]
 
 
 async def get_full_images(image_ids: List[int] = None) -> List[Image]:
-    images = await db.get_images(image_ids)
-    sha1s = list({img.sha1 for img in images})
-    # get ids bound property values
-    property_values = await db.get_property_values(image_ids=image_ids)
-    # get sha1 bound property values when image_ids is set and therefore property_values only return id bound properties
-    if image_ids:
-        sha1s_values = await db.get_property_values(sha1s=sha1s)
-        property_values += sha1s_values
-    ahashs = await db.get_sha1_ahashs(sha1s=sha1s)
-    image_index = {img.id: img for img in images}
-
-    def assign_value(prop_value):
-        image_index[prop_value.image_id].properties[prop_value.property_id] = prop_value
-
-    # fill the index with ids bound property values
-    [assign_value(prop_value) for prop_value in property_values if prop_value.image_id >= 0]
+    images = await db.get_images_with_ahash(image_ids)
+    _fill_properties(images, await db.get_images_property_values(ids=image_ids))
+    return images
 
-    sha1_properties = {}
 
-    def register_sha1_value(prop_value: PropertyValue):
-        if prop_value.sha1 not in sha1_properties:
-            sha1_properties[prop_value.sha1] = []
-        sha1_properties[prop_value.sha1].append(prop_value)
+async def get_images_page(after: int = 0, limit: int = 1000, properties=True, ahash=True) -> List[Image]:
+    """
+    Images with an id greater than after, ordered by id. properties and ahash can be skipped when not needed
+    """
+    images = await db.get_images_page(after, limit, ahash)
+    if properties and images:
+        _fill_properties(images, await db.get_images_property_values(min_id=images[0].id, max_id=images[-1].id))
+    return images
 
-    # populate the index of sha1 properties with prop_values that are bound to sha1s
-    [register_sha1_value(prop_values) for prop_values in property_values if prop_values.image_id < 0]
 
-    def assign_sha1_value(image_id, prop_value: PropertyValue):
-        image_index[image_id].properties[prop_value.property_id] = prop_value
+async def iter_full_images(page_size=1000, properties=True, ahash=True, after=0):
+    """
+    Yield all the images page by page so that they never have to be held in memory together
+    """
+    while True:
+        images = await get_images_page(after, page_size, properties, ahash)
+        if not images:
+            return
+        yield images
+        after = images[-1].id
 
-    # assign the sha1 bound property values to the images with corresponding sha1s
-    [assign_sha1_value(img.id, prop_value) for img in images if img.sha1 in sha1_properties for prop_value in
-     sha1_properties[img.sha1]]
 
-    [setattr(img, 'ahash', ahashs[img.sha1]) for img in images if img.sha1 in ahashs]
-    return images
+def _fill_properties(images: List[Image], property_values: tuple[dict[int, list[PropertyValue]],
+                                                                   dict[str, list[PropertyValue]]]):
+    by_id, by_sha1 = property_values
+    for img in images:
+        values = by_id.get(img.id, []) + by_sha1.get(img.sha1, [])
+        if values:
+            img.properties = {value.property_id: value for value in values}
 
 
 async def make_clusters(sensibility: float, sha1s: [str]) -> Clusters:
@@ -148,13 +161,13 @@ async def make_clusters(sensibility: float, sha1s: [str]) -> Clusters:
     """
     if not sha1s:
         return []
-    values = await db.get_sha1_computed_values(sha1s)
-    clusters, distances = compute.make_clusters(values, method="kmeans", nb_clusters=sensibility)
+    sha1s, vectors = await db.get_vectors(sha1s)
+    clusters, distances = compute.make_clusters(sha1s, vectors, method="kmeans", nb_clusters=sensibility)
     return Clusters(clusters=clusters, distances=distances)
 
 
 async def get_similar_images(sha1s: list[str]):
-    vectors = [i.vector for i in await db.get_sha1_computed_values(sha1s)]
+    _, vectors = await db.get_vectors(sha1s)
     res = compute.get_similar_images(vectors)
     return [img for img in res if img['sha1'] not in sha1s]
 
@@ -175,87 +188,189 @@ async def add_property_to_images(property_id: int, sha1_list: list[str], value:
 
 
 async def read_properties_file(data: pandas.DataFrame):
-    filenames, ids, sha1 = zip(*[(i.name, i.id, i.sha1) for i in await db.get_images()])
-
     # if there are no duplicates them lets assume the props are sha1
-    if data.duplicated('key').sum() == 0:
-        prop_mode = "sha1"
-        matcher = dict(zip(filenames, sha1))
-    else:
-        prop_mode = "id"
-        matcher = dict(zip(filenames, ids))
-    data = data[data.key.isin(filenames)]
-    # data = data.drop_duplicates(subset='key', keep='first')
-    # add panoptic id or sha1 to the dataframe
-    data.loc[data.index, 'panoptic_id'] = data['key'].map(matcher)
+    prop_mode = "sha1" if data.duplicated('key').sum() == 0 else "id"
+    matcher = await _get_key_index(prop_mode)
+    properties = await _create_file_properties(data.columns, prop_mode)
+    await _import_properties_chunk(data, prop_mode, matcher, properties, set())
 
-    # first, create new images where ids are the same
-    unique_ids = list(data.panoptic_id.unique())
-    clones_created = 0
-    # TODO: create clones all at once ? it's tricky with the ids to update
-    if prop_mode == "id":
-        for id_ in tqdm(unique_ids):
-            sub_data = data[data.panoptic_id == id_]
-            # create clones only if needed
-            if len(list(sub_data.panoptic_id)) == 0:
-                continue
-            image = await db.get_images([id_])
-            image = image[0]
-            new_ids = await db.create_clones(image, sub_data.shape[0] - 1)
-            clones_created += len(new_ids)
-            data.loc[data.panoptic_id == id_, "panoptic_id"] = [image.id, *new_ids]
-        logging.getLogger('panoptic').info(f"created {clones_created} new images")
-    properties_to_create = data.columns.tolist()
 
-    # then for each property to create
-    for prop in properties_to_create:
+# progress of the chunked imports of properties files by upload id, read by the /property/file/progress route
+properties_file_progress: dict[str, dict] = {}
+# progress of the finished uploads is kept for the last ones only
+MAX_FINISHED_UPLOADS = 100
+
+
+async def import_properties_file(file, chunk_size=50000, upload_id: str = None) -> dict:
+    """
+    Import a properties csv without loading it in memory: it is read by chunks of chunk_size rows and each chunk
+    is written in its own transaction. Keys are resolved with an index of the filenames built once.
+    The progress is published under upload_id, a new one is made when it isn't given
+    """
+    upload_id = upload_id or uuid.uuid4().hex
+    _forget_finished_uploads()
+    file.seek(0, os.SEEK_END)
+    progress = {'id': upload_id, 'status': 'scan', 'rows': 0, 'imported_rows': 0, 'read_bytes': 0,
+                'total_bytes': file.tell()}
+    properties_file_progress[upload_id] = progress
+    file.seek(0)
+
+    try:
+        # a first pass on the keys only tells if some are duplicated, the file is parsed in a thread
+        duplicated = await asyncio.to_thread(_has_duplicated_keys, file, chunk_size, progress)
+    except BaseException:
+        progress['status'] = 'error'
+        raise
+    prop_mode = "id" if duplicated else "sha1"
+    matcher = await _get_key_index(prop_mode)
+
+    file.seek(0)
+    progress['status'] = 'import'
+    properties = None
+    cloned_ids = set()
+    reader = pd.read_csv(file, sep=";", chunksize=chunk_size)
+    try:
+        while (chunk := await asyncio.to_thread(next, reader, None)) is not None:
+            if properties is None:
+                properties = await _create_file_properties(chunk.columns, prop_mode)
+            async with transaction():
+                await _import_properties_chunk(chunk, prop_mode, matcher, properties, cloned_ids)
+            progress['imported_rows'] += len(chunk)
+            progress['read_bytes'] = file.tell()
+    except BaseException:
+        progress['status'] = 'error'
+        raise
+    finally:
+        reader.close()
+    progress.update(status='done', read_bytes=progress['total_bytes'])
+    return progress
+
+
+def _has_duplicated_keys(file, chunk_size: int, progress: dict) -> bool:
+    """
+    Blocking, to run in a thread
+    """
+    seen_keys = set()
+    duplicated = False
+    for keys in pd.read_csv(file, sep=";", usecols=['key'], chunksize=chunk_size):
+        keys = keys.key
+        duplicated = duplicated or keys.duplicated().any() or keys.isin(seen_keys).any()
+        seen_keys.update(keys.tolist())
+        progress['rows'] += len(keys)
+    return bool(duplicated)
+
+
+def _forget_finished_uploads():
+    finished = [key for key, progress in properties_file_progress.items() if progress['status'] in ('done', 'error')]
+    for key in finished[:max(0, len(finished) - MAX_FINISHED_UPLOADS)]:
+        del properties_file_progress[key]
+
+
+async def _get_key_index(prop_mode: str) -> dict:
+    """
+    Filename to image id, or sha1 when properties are bound to sha1s
+    """
+    images = await db.get_images()
+    if prop_mode == "sha1":
+        return {img.name: img.sha1 for img in images}
+    return {img.name: img.id for img in images}
+
+
+async def _create_file_properties(columns, prop_mode: str) -> dict[str, Property]:
+    properties = {}
+    for prop in columns:
         if prop in ["key", "panoptic_id", "sha1"]:
             continue
-
-        # create the property
         prop_name, prop_type = prop.split('[')
         prop_type = PropertyType(prop_type.split(']')[0])
-        property = await create_property(prop_name, prop_type, prop_mode)
-        # then get all possible values to insert
-        prop_values = list(data[prop].unique())
+        properties[prop] = await create_property(prop_name, prop_type, prop_mode)
+    return properties
+
+
+async def _import_properties_chunk(data: pandas.DataFrame, prop_mode: str, matcher: dict,
+                                   properties: dict[str, Property], used_ids: set[int]):
+    """
+    used_ids are the ids already given to a row of the file, the next rows with the same key get a clone
+    """
+    data = data[data.key.isin(matcher.keys())].copy()
+    # add panoptic id or sha1 to the dataframe
+    data['panoptic_id'] = data['key'].map(matcher)
+
+    # first, create new images where ids are the same: the first row of an id keeps the image, the others get clones
+    if prop_mode == "id":
+        is_clone = ((data.groupby('panoptic_id').cumcount() > 0) | data.panoptic_id.isin(used_ids)).to_numpy()
+        used_ids.update(data.panoptic_id[~is_clone].tolist())
+        images = {img.id: img for img in await db.get_images(data.panoptic_id[is_clone].unique().tolist())}
+        new_ids = await db.clone_images([images[id_] for id_ in data.panoptic_id[is_clone].tolist()])
+        if new_ids:
+            data.loc[is_clone, 'panoptic_id'] = new_ids
+        logging.getLogger('panoptic').info(f"created {len(new_ids)} new images")
+    keys = data.panoptic_id.tolist()
+    if not keys:
+        return
+
+    # then for each property to create
+    for prop, property in properties.items():
+        values = data[prop]
 
         # if it's a tag property let's create the tags in the db
         if property.type == PropertyType.tag or property.type == PropertyType.multi_tags:
-            tag_matcher = {}
-            # TODO: can we optimize to create all tags at once ?
-            for value in tqdm(prop_values):
-                created_tags = []
-                # if value is empty or empty quotes just create a "null" tag
-                if pandas.isna(value) or str(value).strip() == "":
-                    value = "unknown"
-                tags = [value] if property.type == PropertyType.tag else [str(value).split(',')]
+            # if value is empty or empty quotes just create a "unknown" tag
+            values = values.astype(str).where(values.notna() & (values.astype(str).str.strip() != ""), "unknown")
+            if property.type == PropertyType.tag:
+                tag_ids = await create_tags(property.id, values.unique().tolist())
+                values = values.map(lambda value: [tag_ids[value]])
+            else:
                 # if it's multi tag, assume tags are separated by a comma and create them separately
-                for single_tag in tags:
-                    colors = ["7c1314", "c31d20", "f94144", "f3722c", "f8961e", "f9c74f", "90be6d", "43aa8b", "577590",
-                              "9daebe"]
-                    color = '#' + colors[random.randint(0, len(colors) - 1)]
-                    tag = await create_tag(property.id, single_tag, 0, color)
-                    created_tags.append(tag.id)
-                tag_matcher[value] = created_tags
-            # now change all values in the dataframe with the real value that we are going to insert
-            data.loc[data.index, prop] = data[prop].map(tag_matcher)
-        await db.set_multiple_property_values(property.id, list(data[prop]), list(data.panoptic_id))
-
-
-async def export_properties(images_id=None, properties_list=None) -> io.StringIO:
+                single_tags = values.str.split(',').explode()
+                tag_ids = await create_tags(property.id, single_tags.unique().tolist())
+                values = single_tags.map(tag_ids).groupby(level=0, sort=False).agg(list)
+        await db.set_multiple_property_values(property.id, values.tolist(), keys)
+
+
+TAG_COLORS = ["7c1314", "c31d20", "f94144", "f3722c", "f8961e", "f9c74f", "90be6d", "43aa8b", "577590", "9daebe"]
+
+
+async def create_tags(property_id: int, values: list[str], parent_id=0) -> dict[str, int]:
     """
-    Allow to export selected images and properties into a csv file
+    Bulk version of create_tag: the missing tags are created together with a random color and the existing ones
+    get parent_id as a new parent. Returns the id of the tag of each value
+    """
+    existing = await db.get_tags_by_value(property_id)
+    graph = await get_tag_graph(property_id)
+    updated = []
+    for value in values:
+        tag = existing.get(value)
+        if tag is None or parent_id in tag.parents:
+            continue
+        if graph.creates_cycle(tag.id, parent_id):
+            raise HTTPException(status_code=400, detail="Adding a tag that is an ancestor of himself")
+        tag.parents = list({*tag.parents, parent_id})
+        updated.append(tag)
+    await db.update_tags_parents(updated)
+
+    new_values = [value for value in dict.fromkeys(values) if value not in existing]
+    colors = ['#' + random.choice(TAG_COLORS) for _ in new_values]
+    new_ids = await db.add_tags(property_id, new_values, json.dumps([parent_id]), colors)
+    return {**{value: tag.id for value, tag in existing.items()}, **dict(zip(new_values, new_ids))}
+
+
+async def export_properties(images_id=None, properties_list=None, page_size=1000) \
+        -> tuple[list[str], list[PropertyType | None], AsyncIterator[list[list]]]:
+    """
+    Allow to export selected images and properties: returns the columns, their property type and
+    the rows, produced page by page while images are read
     """
-    images = await get_full_images(images_id)
     properties = await get_properties()
-    tags = await get_tags()
+    tags = {prop_id: {tag.id: tag.value for tag in prop_tags.values()} for prop_id, prop_tags in (await get_tags()).items()}
 
     # filter properties id that we want to keep
-    properties_list =  list(properties.keys()) if not properties_list else properties_list
+    properties_list = list(properties.keys()) if not properties_list else properties_list
     properties = [properties[pid] for pid in properties_list]
     columns = ["key", "sha1[string]"] + [f"{p.name}[{p.type.value}]" for p in properties]
-    rows = []
-    for image in images:
+    types = [None, PropertyType.string] + [p.type for p in properties]
+
+    def to_row(image: Image):
         row = [image.name, image.sha1]
         for prop in properties:
             if prop.id in image.properties:
@@ -265,17 +380,26 @@ async def export_properties(images_id=None, properties_list=None) -> io.StringIO
                     if type(value) != list:
                         row.append(None)
                         continue
-                    row.append(",".join([tags[prop.id][t].value for t in value]))
+                    row.append(",".join([tags[prop.id][t] for t in value]))
+                elif isinstance(value, float) and math.isnan(value):
+                    # empty cells of imported files are stored as NaN
+                    row.append(None)
                 else:
                     row.append(value)
             else:
                 row.append(None)
-        rows.append(row)
-    df = pd.DataFrame.from_records(rows, columns=columns)
-    buff = io.StringIO()
-    df.to_csv(path_or_buf=buff, index=False, sep=";")
-    buff.seek(0)
-    return buff
+        return row
+
+    async def pages():
+        if images_id:
+            ids = sorted(set(images_id))
+            for i in range(0, len(ids), page_size):
+                yield [to_row(image) for image in await get_full_images(ids[i:i + page_size])]
+        else:
+            async for images in iter_full_images(page_size, ahash=False):
+                yield [to_row(image) for image in images]
+
+    return columns, types, pages()
 
 
 async def add_folder(folder):
@@ -284,6 +408,12 @@ async def add_folder(folder):
     return folder
 
 
+async def sync_folder(folder) -> dict[str, int]:
+    diff = await importer.sync_folder(folder)
+    logging.getLogger('panoptic').info(f'synced {folder}: {diff}')
+    return diff
+
+
 new_images = []
 
 
@@ -296,7 +426,8 @@ def get_new_images():
 async def create_tag(property_id, value, parent_id, color: str) -> Tag:
     existing_tag = await db.get_tag(property_id, value)
     if existing_tag is not None:
-        if await db.tag_in_ancestors(existing_tag.id, parent_id):
+        graph = await get_tag_graph(property_id)
+        if graph.creates_cycle(existing_tag.id, parent_id):
             raise HTTPException(status_code=400, detail="Adding a tag that is an ancestor of himself")
         existing_tag.parents = list({*existing_tag.parents, parent_id})
         await db.update_tag(existing_tag)
@@ -311,7 +442,8 @@ async def update_tag(payload: UpdateTagPayload) -> Tag:
     existing_tag = await db.get_tag_by_id(payload.id)
     if not existing_tag:
         raise HTTPException(status_code=400, detail="Trying to modify non existent tag")
-    if await db.tag_in_ancestors(existing_tag.id, payload.parent_id):
+    graph = await get_tag_graph(existing_tag.property_id)
+    if graph.creates_cycle(existing_tag.id, payload.parent_id):
         raise HTTPException(status_code=400, detail="Adding a tag that is an ancestor of himself")
     # change only fields of the tags that are set in the payload
     new_tag = existing_tag.copy(update=payload.dict(exclude_unset=True))
@@ -320,23 +452,23 @@ async def update_tag(payload: UpdateTagPayload) -> Tag:
 
 
 async def delete_tag(tag_id: int) -> List[int]:
-    print('delete tag from values')
-    # first delete the tag
-    modified_tags = [await db.delete_tag_by_id(tag_id)]
-    # when deleting a tag, get all children of this tag
-    children = await db.get_tags_by_parent_id(tag_id)
-    # and remove parent ref of tag in children
-    [modified_tags.extend(await delete_tag_parent(c.id, tag_id)) for c in children]
-    # then get all images properties tagged with it
-    property_values = await db.get_property_values_with_tag(tag_id)
-    # and delete the tag ref from them
-    for data in property_values:
-        if tag_id in data.value:
-            data.value.remove(tag_id)
-            if data.image_id >= 0:
-                await db.set_property_values(data.property_id, data.value, image_ids=[data.image_id])
-            else:
-                await db.set_property_values(data.property_id, data.value, sha1s=[data.sha1])
+    """
+    Delete a tag with the children left without parent, recursively, and remove them from the images.
+    Everything is written in one transaction, returns the ids of the deleted tags
+    """
+    tag = await db.get_tag_by_id(tag_id)
+    if tag is None:
+        return [tag_id]
+    graph = await get_tag_graph(tag.property_id)
+    # a child is deleted once all its parents are deleted
+    modified_tags = [tag_id, *graph.orphaned_descendants({tag_id})]
+    deleted = set(modified_tags)
+
+    # tags of the graph are shared, the children that keep some parents are saved from copies
+    updated_tags = [Tag(t.id, t.property_id, [p for p in t.parents if p not in deleted], t.value, t.color)
+                    for t in graph.tags.values()
+                    if t.id not in deleted and any(parent in deleted for parent in t.parents)]
+    await db.delete_tags(modified_tags, updated_tags)
     return modified_tags
 
 
@@ -351,6 +483,28 @@ async def delete_tag_parent(tag_id: int, parent_id: int) -> List[int]:
         return []
 
 
+async def get_tag_counts(property_id: int = None) -> dict[int, int]:
+    return await db.get_tag_counts(property_id)
+
+
+async def get_images_with_tags(tag_ids: list[int], with_descendants=False) -> list[int]:
+    """
+    Ids of the images having one of the tags, or one of their descendants with with_descendants
+    """
+    if with_descendants:
+        tag_ids = set(tag_ids)
+        for tag in await db.get_tags_by_ids(list(tag_ids)):
+            tag_ids.update((await get_tag_graph(tag.property_id)).descendants(tag.id))
+    return await db.get_images_with_tags(list(tag_ids))
+
+
+async def get_tag_descendants(tag_id: int) -> list[int]:
+    tag = await db.get_tag_by_id(tag_id)
+    if tag is None:
+        raise HTTPException(status_code=400, detail="Trying to get descendants of non existent tag")
+    return sorted((await get_tag_graph(tag.property_id)).descendants(tag_id))
+
+
 async def get_tags(prop: str = None) -> Tags:
     res = {}
     tag_list = await db.get_tags(prop)
@@ -1,15 +1,29 @@
 # Connexion à la base de données SQLite
+import gc
 import json
+from contextlib import contextmanager
+from functools import partial
 from typing import List, Any
 
 import numpy as np
-from pypika import Table, Parameter, PostgreSQLQuery
 
-from panoptic.core.db_utils import execute_query, decode_if_json, execute_query_many
+from panoptic.core.db_utils import execute_query, decode_if_json, execute_query_many, transaction, \
+    fetch_in_chunks, execute_in_chunks, in_query, insert_many, after_transaction, read_snapshot
+from panoptic.core.tag_graph import invalidate_tag_graph
+from panoptic.core.vector_store import get_store
 from panoptic.models import PropertyValue, Image, ComputedValue
 from panoptic.models import Tag, Property, Folder, Tab
 
-Query = PostgreSQLQuery
+# statements used in loops are written once with parameters, so that sqlite reuses their compiled version
+INSERT_IMAGE = 'INSERT INTO images (folder_id, name, extension, sha1, url, width, height) VALUES (?, ?, ?, ?, ?, ?, ?)'
+SELECT_IMAGE_FILE = 'SELECT * FROM images WHERE folder_id = ? AND name = ? AND extension = ? LIMIT 1'
+UPSERT_PROPERTY_VALUE = 'INSERT INTO property_values (property_id, image_id, sha1, value) VALUES (?, ?, ?, ?) ' \
+                        'ON CONFLICT (property_id, image_id, sha1) DO UPDATE SET value=excluded.value'
+
+
+def _tags_changed(property_id: int = None):
+    # the graph is only forgotten once the change is committed, it could be loaded again from the old tags otherwise
+    after_transaction(partial(invalidate_tag_graph, property_id))
 
 
 async def add_property(name: str, property_type: str, mode: str) -> Property:
@@ -22,80 +36,262 @@ async def add_property(name: str, property_type: str, mode: str) -> Property:
 async def add_tag(property_id: int, value: str, parents: str, color: str):
     query = "INSERT INTO tags (property_id, value, parents, color) VALUES (?, ?, ?, ?)"
     cursor = await execute_query(query, (property_id, value, parents, color))
+    _tags_changed(property_id)
     return cursor.lastrowid
 
 
+async def add_tags(property_id: int, values: list[str], parents: str, colors: list[str]) -> list[int]:
+    """
+    Insert several tags of a property in one transaction, returns their ids in the same order
+    """
+    query = "INSERT INTO tags (property_id, value, parents, color) VALUES (?, ?, ?, ?)"
+    ids = await insert_many('tags', query, [(property_id, value, parents, color) for value, color in zip(values, colors)])
+    _tags_changed(property_id)
+    return ids
+
+
+async def update_tags_parents(tags: list[Tag]):
+    query = "UPDATE tags SET parents = ? WHERE id = ?"
+    await execute_query_many(query, [(json.dumps(tag.parents), tag.id) for tag in tags])
+    [_tags_changed(property_id) for property_id in {tag.property_id for tag in tags}]
+
+
 async def update_tag(tag: Tag):
     query = "UPDATE tags SET parents = ?, value = ?, color = ? WHERE id = ?"
     await execute_query(query, (json.dumps(tag.parents), tag.value, tag.color, tag.id))
+    _tags_changed(tag.property_id)
 
 
 async def create_clones(image: Image, nb_clones: int) -> list[int]:
-    table = Table('images')
-    query = Query.into(table).columns(
-        'folder_id',
-        'name',
-        'extension',
-        'sha1',
-        'url',
-        'width',
-        'height').insert(*[Parameter('?') for _ in range(7)])
-    data = [(
-            image.folder_id, image.name, image.extension, image.sha1, image.url, image.width, image.height)] * nb_clones
-    await execute_query_many(query.get_sql(), data)
-    new_query = "SELECT id FROM images ORDER BY id DESC LIMIT ?"
-    cursor = await execute_query(new_query, (nb_clones,))
-    return [x[0] for x in await cursor.fetchall()]
+    return await clone_images([image] * nb_clones)
+
+
+async def clone_images(images: list[Image]) -> list[int]:
+    """
+    Insert a copy of each image in one transaction, returns the ids of the copies in the same order
+    """
+    data = [(image.folder_id, image.name, image.extension, image.sha1, image.url, image.width, image.height)
+            for image in images]
+    return await insert_many('images', INSERT_IMAGE, data)
 
 
 async def add_image(folder_id: int, name: str, extension: str, sha1: str, url: str, width: int, height: int, **kwargs):
-    table = Table('images')
-    query = Query.into(table).columns(
-        'folder_id',
-        'name',
-        'extension',
-        'sha1',
-        'url',
-        'width',
-        'height').insert((
-        folder_id,
-        name,
-        extension,
-        sha1,
-        url,
-        width,
-        height))
-    cursor = await execute_query(query.get_sql())
-    id_ = cursor.lastrowid
-
-    return Image(id=id_, folder_id=folder_id, name=name, extension=extension, sha1=sha1, url=url, width=width,
-                 height=height)
+    cursor = await execute_query(INSERT_IMAGE, (folder_id, name, extension, sha1, url, width, height))
+    return Image(id=cursor.lastrowid, folder_id=folder_id, name=name, extension=extension, sha1=sha1, url=url,
+                 width=width, height=height)
 
 
-async def has_image_file(folder_id, name, extension):
-    table = Table('images')
-    query = Query.from_(table).select('*').where(table.folder_id == folder_id)
-    query = query.where(table.name == name).where(table.extension == extension).limit(1)
+async def add_images(images: list[tuple[int, str, str, str, str, int, int]]) -> list[int]:
+    """
+    Insert several images in one transaction, returns their ids in the same order
+    images: (folder_id, name, extension, sha1, url, width, height) tuples
+    """
+    return await insert_many('images', INSERT_IMAGE, images)
 
-    cursor = await execute_query(query.get_sql())
+
+async def has_image_file(folder_id, name, extension):
+    cursor = await execute_query(SELECT_IMAGE_FILE, (folder_id, name, extension))
     res = await cursor.fetchone()
     if res:
         return Image(*res)
     return False
 
 
+def _folder_tree_clause(root_path: str) -> tuple[str, tuple]:
+    """
+    WHERE clause selecting a folder and all its sub folders by path
+    """
+    prefix = root_path + '/'
+    return 'folders.path = ? OR substr(folders.path, 1, ?) = ?', (root_path, len(prefix), prefix)
+
+
+async def get_folder_tree_files(root_path: str) -> dict[tuple[int, str, str], tuple[int, int, int]]:
+    """
+    Index of the images already imported from this folder tree:
+    (folder_id, name, extension) -> (size, mtime, inode), values are None for files imported without fingerprint
+    """
+    clause, params = _folder_tree_clause(root_path)
+    query = f"""
+            SELECT DISTINCT images.folder_id, images.name, images.extension,
+                image_files.size, image_files.mtime, image_files.inode
+            FROM images JOIN folders ON folders.id = images.folder_id
+            LEFT JOIN image_files ON image_files.folder_id = images.folder_id
+                AND image_files.name = images.name AND image_files.extension = images.extension
+            WHERE {clause}
+        """
+    cursor = await execute_query(query, params)
+    return {tuple(row[:3]): tuple(row[3:]) for row in await cursor.fetchall()}
+
+
+_image_file_query = 'INSERT INTO image_files (folder_id, name, extension, size, mtime, inode) VALUES (?, ?, ?, ?, ?, ?) ' \
+                    'ON CONFLICT (folder_id, name, extension) ' \
+                    'DO UPDATE SET size=excluded.size, mtime=excluded.mtime, inode=excluded.inode'
+
+async def set_image_files(files: list[tuple[int, str, str, int, int, int]]):
+    """
+    files: (folder_id, name, extension, size, mtime, inode) tuples
+    """
+    await execute_query_many(_image_file_query, files)
+
+
+async def update_image_file(folder_id: int, name: str, extension: str, sha1: str, width: int, height: int) \
+        -> tuple[list[int], list[str]]:
+    """
+    Update the images (and their clones) of a file whose content changed, returns their ids and their previous sha1s.
+    No ids are returned when the images were deleted meanwhile
+    """
+    async with transaction():
+        query = 'SELECT id, sha1 FROM images WHERE folder_id = ? AND name = ? AND extension = ? ORDER BY id'
+        cursor = await execute_query(query, (folder_id, name, extension))
+        rows = await cursor.fetchall()
+        query = 'UPDATE images SET sha1 = ?, width = ?, height = ? WHERE folder_id = ? AND name = ? AND extension = ?'
+        await execute_query(query, (sha1, width, height, folder_id, name, extension))
+    return [row[0] for row in rows], list({row[1] for row in rows if row[1] != sha1})
+
+
+async def delete_image_files(files: list[tuple[int, str, str]]) -> list[str]:
+    """
+    Delete the images (and their clones) of removed files, with their id bound property values.
+    Returns the sha1s of the deleted images
+    files: (folder_id, name, extension) tuples
+    """
+    async with transaction():
+        sha1s = set()
+        for file in files:
+            cursor = await execute_query('SELECT sha1 FROM images WHERE folder_id = ? AND name = ? AND extension = ?',
+                                         file)
+            sha1s.update(row[0] for row in await cursor.fetchall())
+        await execute_query_many('DELETE FROM property_values WHERE image_id IN '
+                                 '(SELECT id FROM images WHERE folder_id = ? AND name = ? AND extension = ?)', files)
+        await execute_query_many('DELETE FROM images WHERE folder_id = ? AND name = ? AND extension = ?', files)
+        await execute_query_many('DELETE FROM image_files WHERE folder_id = ? AND name = ? AND extension = ?', files)
+    return list(sha1s)
+
+
+async def delete_unused_computed_values(sha1s: list[str]) -> list[str]:
+    """
+    Delete the computed values of the sha1s that no image uses anymore, returns these sha1s.
+    Their vectors are removed from the similarity index at its next update
+    """
+    if not sha1s:
+        return []
+    async with transaction():
+        used = {row[0] for row in await fetch_in_chunks('SELECT DISTINCT sha1 FROM images WHERE sha1 IN ({values})',
+                                                        sha1s)}
+        unused = [sha1 for sha1 in sha1s if sha1 not in used]
+        await execute_in_chunks('DELETE FROM computed_values WHERE sha1 IN ({values})', unused)
+    return unused
+
+
+async def get_folder_tree_uncomputed_images(root_path: str) -> list[tuple[int, str]]:
+    """
+    (id, sha1) of the images of this folder tree whose vector was never computed
+    """
+    clause, params = _folder_tree_clause(root_path)
+    query = f"""
+            SELECT images.id, images.sha1
+            FROM images JOIN folders ON folders.id = images.folder_id
+            LEFT JOIN computed_values ON computed_values.sha1 = images.sha1
+            WHERE ({clause}) AND computed_values.sha1 IS NULL
+        """
+    cursor = await execute_query(query, params)
+    return [tuple(row) for row in await cursor.fetchall()]
+
+
 async def get_images(ids: List[int] = None, sha1s: List[str] = None):
-    img_table = Table('images')
-    query = Query.from_(img_table).select('*')
+    if ids:
+        # ids are sorted so that chunks come back in id order, like a single query would
+        rows = await fetch_in_chunks("SELECT * FROM images WHERE id IN ({values})", sorted(set(ids)))
+        if sha1s:
+            sha1s = set(sha1s)
+            rows = [row for row in rows if row[4] in sha1s]
+    elif sha1s:
+        rows = await fetch_in_chunks("SELECT * FROM images WHERE sha1 IN ({values})", list(set(sha1s)),
+                                     key=lambda row: row[0])
+    else:
+        cursor = await execute_query("SELECT * FROM images")
+        rows = await cursor.fetchall()
+    images = [Image(*image) for image in rows]
+    return images
+
 
+async def get_images_page(after: int = 0, limit: int = 1000, ahash=False) -> List[Image]:
+    """
+    Images ordered by id, only the ones with an id greater than after.
+    Pages are read with the primary key so each page costs the same whatever its position
+    """
+    query = _full_images_query(ahash) + " WHERE i.id > ? ORDER BY i.id LIMIT ?"
+    cursor = await execute_query(query, (after, limit))
+    return [Image(*row[:8], {}, row[8]) for row in await cursor.fetchall()]
+
+
+async def get_images_with_ahash(ids: List[int] = None) -> List[Image]:
+    """
+    Images with their ahash read in the same query
+    """
+    query = _full_images_query(ahash=True)
     if ids:
-        query = query.where(img_table.id.isin(ids))
-    if sha1s:
-        query = query.where(img_table.sha1.isin(sha1s))
+        rows = await fetch_in_chunks(query + " WHERE i.id IN ({values})", sorted(set(ids)))
+    else:
+        cursor = await execute_query(query)
+        rows = await cursor.fetchall()
+    return [Image(*row[:8], {}, row[8]) for row in rows]
 
-    cursor = await execute_query(query.get_sql())
-    images = [Image(*image) for image in await cursor.fetchall()]
-    return images
+
+def _full_images_query(ahash: bool):
+    if not ahash:
+        return "SELECT i.*, NULL FROM images i"
+    return "SELECT i.*, c.ahash FROM images i LEFT JOIN computed_values c ON c.sha1 = i.sha1"
+
+
+async def get_images_property_values(ids: List[int] = None, min_id: int = None, max_id: int = None) \
+        -> tuple[dict[int, list[PropertyValue]], dict[str, list[PropertyValue]]]:
+    """
+    Property values of the images, grouped by the image id they are bound to and by sha1 for the sha1 bound ones.
+    Images are selected with their ids or with an id range, all images by default.
+    Only the value column is decoded, a sha1 bound value is read once whatever the number of images with this sha1
+    """
+    id_query = "SELECT property_id, image_id, sha1, value FROM property_values WHERE image_id >= 0"
+    sha1_query = "SELECT property_id, image_id, sha1, value FROM property_values WHERE image_id = -1"
+    if ids:
+        id_rows = await fetch_in_chunks(id_query + " AND image_id IN ({values})", sorted(set(ids)))
+        sha1_rows = await fetch_in_chunks(sha1_query + " AND sha1 IN (SELECT sha1 FROM images WHERE id IN ({values}))",
+                                          sorted(set(ids)))
+        # chunks can share sha1s
+        sha1_rows = list({(row[2], row[0]): row for row in sha1_rows}.values())
+    else:
+        params = ()
+        if min_id is not None:
+            id_query += " AND image_id BETWEEN ? AND ?"
+            sha1_query += " AND sha1 IN (SELECT sha1 FROM images WHERE id BETWEEN ? AND ?)"
+            params = (min_id, max_id)
+        async with read_snapshot():
+            id_rows = await (await execute_query(id_query, params)).fetchall()
+            sha1_rows = await (await execute_query(sha1_query, params)).fetchall()
+
+    by_id: dict[int, list[PropertyValue]] = {}
+    by_sha1: dict[str, list[PropertyValue]] = {}
+    with _gc_paused():
+        for property_id, image_id, sha1, value in id_rows:
+            by_id.setdefault(image_id, []).append(PropertyValue(property_id, image_id, sha1, decode_if_json(value)))
+        for property_id, image_id, sha1, value in sha1_rows:
+            by_sha1.setdefault(sha1, []).append(PropertyValue(property_id, image_id, sha1, decode_if_json(value)))
+    return by_id, by_sha1
+
+
+@contextmanager
+def _gc_paused():
+    """
+    Millions of values are allocated and none freed, the collections triggered by the allocations would scan them
+    again and again for nothing. Nothing else runs meanwhile, there is no await inside
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
 
 
 async def get_sha1_count():
@@ -106,19 +302,30 @@ async def get_sha1_count():
 
 
 async def get_property_values(property_ids: List[int] = None, image_ids: List[int] = None, sha1s: List[str] = None):
-    values = Table('property_values')
-    query = Query.from_(values).select('*')
-
+    query = "SELECT * FROM property_values"
+    conditions = []
+    params = ()
     if property_ids:
-        query = query.where(values.property_id.isin(property_ids))
+        conditions.append(in_query("property_id IN ({values})", len(property_ids)))
+        params = tuple(property_ids)
 
+    values = None
     if image_ids:
-        query = query.where(values.image_id.isin(image_ids))
+        conditions.append("image_id IN ({values})")
+        values = sorted(set(image_ids))
     elif sha1s:
-        query = query.where(values.sha1.isin(sha1s))
+        conditions.append("sha1 IN ({values})")
+        values = list(set(sha1s))
 
-    cursor = await execute_query(query.get_sql())
-    res = [PropertyValue(**auto_dict(image, cursor)) for image in await cursor.fetchall()]
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if values is not None:
+        rows = await fetch_in_chunks(query, values, params, key=lambda row: row[:3])
+    else:
+        cursor = await execute_query(query, params)
+        rows = await cursor.fetchall()
+    res = [PropertyValue(property_id, image_id, sha1, decode_if_json(value))
+           for property_id, image_id, sha1, value in rows]
     return res
 
 
@@ -126,15 +333,13 @@ async def delete_property_value(property_id, image_ids: List[int] = None, sha1s:
     if image_ids and sha1s:
         raise TypeError('Only image_ids or sha1s should be given as keys. Never both')
 
-    t = Table('property_values')
-    query = Query.from_(t).delete().where(t.property_id == property_id)
-
+    query = "DELETE FROM property_values WHERE property_id = ?"
     if image_ids:
-        query = query.where(t.image_id.isin(image_ids))
+        await execute_in_chunks(query + " AND image_id IN ({values})", image_ids, (property_id,))
     elif sha1s:
-        query = query.where(t.sha1.isin(sha1s))
-
-    await execute_query(query.get_sql())
+        await execute_in_chunks(query + " AND sha1 IN ({values})", sha1s, (property_id,))
+    else:
+        await execute_query(query, (property_id,))
 
 
 async def get_property_by_id(property_id) -> [Property | None]:
@@ -160,20 +365,6 @@ async def get_tag(property_id, value):
     return Tag(**auto_dict(row, cursor))
 
 
-async def get_tag_ancestors(tag: Tag, acc=None):
-    if not acc:
-        acc = []
-    if tag.parents == [0]:
-        return list({*tag.parents, *acc})
-    else:
-        acc = acc + tag.parents
-        for parent in tag.parents:
-            if parent == 0:
-                continue
-            parent_tag = await get_tag_by_id(parent)
-            return await get_tag_ancestors(parent_tag, acc)
-
-
 def auto_dict(row, cursor):
     return {key: decode_if_json(value) for key, value in zip([c[0] for c in cursor.description], row)}
 
@@ -197,29 +388,57 @@ async def get_tag_by_id(tag_id: int):
     return None
 
 
+async def get_tags_by_value(property_id: int) -> dict[str, Tag]:
+    """
+    Tags of a property indexed by their value, values are kept as stored
+    """
+    query = "SELECT id, property_id, parents, value, color FROM tags WHERE property_id = ?"
+    cursor = await execute_query(query, (property_id,))
+    return {value: Tag(id_, property_id, json.loads(parents), value, color)
+            for id_, property_id, parents, value, color in await cursor.fetchall()}
+
+
+async def get_tags_by_ids(tag_ids: list[int]) -> list[Tag]:
+    rows = await fetch_in_chunks("SELECT id, property_id, parents, value, color FROM tags WHERE id IN ({values})",
+                                 sorted(set(tag_ids)))
+    return [Tag(id_, property_id, json.loads(parents), value, color) for id_, property_id, parents, value, color in rows]
+
+
 async def delete_tag_by_id(tag_id: int) -> int:
     query = "DELETE FROM tags WHERE id = ?"
     await execute_query(query, (tag_id,))
+    _tags_changed()
     return tag_id
 
 
+async def delete_tags(tag_ids: list[int], updated_tags: list[Tag]):
+    """
+    Delete several tags in one transaction: the tags are removed from the property values using them
+    and updated_tags, the children that lost some parents, are saved
+    """
+    tag_ids = json.dumps(tag_ids)
+    async with transaction():
+        _tags_changed()
+        await execute_query("DELETE FROM tags WHERE id IN (SELECT value FROM json_each(?))", (tag_ids,))
+        await update_tags_parents(updated_tags)
+        # values are rewritten in SQL, only the ones found with the image_tags index
+        query = """
+                UPDATE property_values
+                SET value = (SELECT json_group_array(j.value) FROM json_each(property_values.value) j
+                             WHERE j.value NOT IN (SELECT value FROM json_each(?1)))
+                WHERE (property_id, image_id, sha1) IN (
+                    SELECT property_id, image_id, sha1 FROM image_tags WHERE tag_id IN (SELECT value FROM json_each(?1))
+                )
+            """
+        await execute_query(query, (tag_ids,))
+
+
 async def get_tags_by_parent_id(parent_id: int):
     query = "SELECT tags.* FROM tags, json_each(tags.parents) WHERE json_each.value = ?"
     cursor = await execute_query(query, (parent_id,))
     return [Tag(**auto_dict(row, cursor)) for row in await cursor.fetchall()]
 
 
-async def tag_in_ancestors(tag_id, parent_id) -> bool:
-    if not parent_id:
-        return False
-    else:
-        parent = await get_tag_by_id(parent_id)
-        ancestors = await get_tag_ancestors(parent)
-        if tag_id in ancestors:
-            return True
-    return False
-
-
 async def get_properties() -> list[Property]:
     query = "SELECT * from properties"
     cursor = await execute_query(query)
@@ -233,9 +452,8 @@ async def get_folders() -> List[Folder]:
 
 
 async def get_folder(folder_id: int):
-    table = Table('folders')
-    query = Query.from_(table).select('*').where(table.id == folder_id)
-    cursor = await execute_query(query.get_sql())
+    query = "SELECT * FROM folders WHERE id = ?"
+    cursor = await execute_query(query, (folder_id,))
     row = await cursor.fetchone()
 
     return Folder(**auto_dict(row, cursor))
@@ -284,6 +502,7 @@ async def delete_tab(tab_id: int):
 async def delete_property(property_id):
     query = "DELETE from properties WHERE id = ?"
     await execute_query(query, (property_id,))
+    _tags_changed(property_id)
 
 
 async def update_property(new_property: Property):
@@ -292,9 +511,49 @@ async def update_property(new_property: Property):
 
 
 async def get_property_values_with_tag(tag_id: int) -> list[PropertyValue]:
-    query = "SELECT * from property_values where value like ?"
-    cursor = await execute_query(query, (f"[%{tag_id}%]",))
-    return [PropertyValue(**auto_dict(row, cursor)) for row in await cursor.fetchall()]
+    query = """
+            SELECT pv.property_id, pv.image_id, pv.sha1, pv.value
+            FROM image_tags t JOIN property_values pv
+            ON pv.property_id = t.property_id AND pv.image_id = t.image_id AND pv.sha1 = t.sha1
+            WHERE t.tag_id = ?
+        """
+    cursor = await execute_query(query, (tag_id,))
+    return [PropertyValue(property_id, image_id, sha1, decode_if_json(value))
+            for property_id, image_id, sha1, value in await cursor.fetchall()]
+
+
+async def get_tag_counts(property_id: int = None) -> dict[int, int]:
+    """
+    Number of images using each tag, sha1 bound values count once for each image with this sha1
+    """
+    where = ""
+    params = ()
+    if property_id is not None:
+        where = " AND t.property_id = ?"
+        params = (property_id,)
+    query = f"""
+            SELECT tag_id, COUNT(*) FROM (
+                SELECT t.tag_id FROM image_tags t WHERE t.image_id >= 0 {where}
+                UNION ALL
+                SELECT t.tag_id FROM image_tags t JOIN images i ON i.sha1 = t.sha1 WHERE +t.image_id = -1 {where}
+            ) GROUP BY tag_id
+        """
+    cursor = await execute_query(query, params + params)
+    return {tag_id: count for tag_id, count in await cursor.fetchall()}
+
+
+async def get_images_with_tags(tag_ids: list[int]) -> list[int]:
+    """
+    Ids of the images having at least one of the tags
+    """
+    query = """
+            SELECT t.image_id FROM image_tags t WHERE t.tag_id IN ({values}) AND t.image_id >= 0
+            UNION
+            SELECT i.id FROM image_tags t JOIN images i ON i.sha1 = t.sha1
+            WHERE t.tag_id IN ({values}) AND +t.image_id = -1
+        """
+    rows = await fetch_in_chunks(query, list(set(tag_ids)))
+    return sorted({row[0] for row in rows})
 
 
 async def set_property_values(property_id: int, value: Any, image_ids: List[int] = None, sha1s: List[str] = None):
@@ -302,15 +561,11 @@ async def set_property_values(property_id: int, value: Any, image_ids: List[int]
     Set property values for several image_ids / sha1 but with only one possible value !
     """
     value = json.dumps(value)
-    t = Table('property_values')
-    query = Query.into(t).columns('property_id', 'image_id', 'sha1', 'value')
     if image_ids:
-        query = query.insert(*[(property_id, img_id, '', value) for img_id in image_ids])
-    elif sha1s:
-        query = query.insert(*[(property_id, -1, sha1, value) for sha1 in sha1s])
-
-    query = query.get_sql() + ' ON CONFLICT (property_id, image_id, sha1) DO UPDATE SET value=excluded.value'
-    await execute_query(query)
+        data = [(property_id, img_id, '', value) for img_id in image_ids]
+    else:
+        data = [(property_id, -1, sha1, value) for sha1 in sha1s]
+    await execute_query_many(UPSERT_PROPERTY_VALUE, data)
 
     updated_ids = image_ids
     if not image_ids:
@@ -323,29 +578,37 @@ async def set_multiple_property_values(property_id: int, values: list[Any], imag
     """
     Set property values for several image_ids / sha1 and several values, there must be as much ids / sha1 than values
     """
-    t = Table('property_values')
-    query = Query.into(t).columns('property_id', 'image_id', 'sha1', 'value')
     if isinstance(images_ids_or_sha1[0], str):
-        query = query.insert((property_id, -1, Parameter('?'), Parameter('?')))
+        data = [(property_id, -1, sha1, json.dumps(value)) for sha1, value in zip(images_ids_or_sha1, values)]
     else:
-        query = query.insert((property_id, Parameter('?'), '', Parameter('?')))
-    query = query.get_sql() + ' ON CONFLICT (property_id, image_id, sha1) DO UPDATE SET value=excluded.value'
-    await execute_query_many(query, [(id_, json.dumps(value)) for id_, value in zip(images_ids_or_sha1, values)])
+        data = [(property_id, id_, '', json.dumps(value)) for id_, value in zip(images_ids_or_sha1, values)]
+    await execute_query_many(UPSERT_PROPERTY_VALUE, data)
 
 
 async def set_computed_value(sha1: str, ahash: str, vector: np.array):
-    t = Table('computed_values')
-    query = Query.into(t).columns('sha1', 'ahash', 'vector').insert(sha1, ahash, Parameter('?'))
-    query = query.on_conflict('sha1').do_update('vector', Parameter('?'))
-    # query = query.get_sql() + " ON CONFLICT(sha1) DO NOTHING"
-    await execute_query(query.get_sql(), (vector, vector))
-    return ComputedValue(sha1, ahash, vector)
+    return (await set_computed_values([ComputedValue(sha1, ahash, vector)]))[0]
+
+
+async def set_computed_values(values: list[ComputedValue]):
+    """
+    Insert or update several computed values in a single transaction, their vectors are written in the vector store
+    """
+    query = 'INSERT INTO computed_values (sha1, ahash) VALUES (?, ?) ' \
+            'ON CONFLICT (sha1) DO UPDATE SET ahash=excluded.ahash'
+    sha1s = [v.sha1 for v in values]
+    async with transaction():
+        await execute_query_many(query, [(v.sha1, v.ahash) for v in values])
+        ids = dict(await fetch_in_chunks("SELECT sha1, id FROM computed_values WHERE sha1 IN ({values})", sha1s))
+        for v in values:
+            v.id = ids[v.sha1]
+        # written before the commit: if the store can't be written the rows are rolled back and computed again later
+        get_store().write([v.id for v in values], [v.vector for v in values])
+    return values
 
 
 async def get_sha1s_by_filenames(filenames: list[str]) -> list[str]:
-    query = "SELECT sha1 from images where name in " + "(" + ','.join('?' * len(filenames)) + ') order by name'
-    cursor = await execute_query(query, tuple(filenames))
-    return await cursor.fetchall()
+    rows = await fetch_in_chunks("SELECT sha1, name from images where name in ({values})", list(set(filenames)))
+    return [row[:1] for row in sorted(rows, key=lambda row: row[1])]
 
 
 async def vacuum():
@@ -353,24 +616,75 @@ async def vacuum():
     await execute_query(query)
 
 
+async def get_sha1_by_url(url: str) -> str | None:
+    cursor = await execute_query('SELECT sha1 FROM images WHERE url = ? LIMIT 1', (url,))
+    row = await cursor.fetchone()
+    return row[0] if row else None
+
+
+async def get_image_paths(sha1: str) -> list[str]:
+    """
+    Files of the images with this sha1, from their url
+    """
+    cursor = await execute_query('SELECT url FROM images WHERE sha1 = ?', (sha1,))
+    return [row[0][len('/images/'):] for row in await cursor.fetchall()]
+
+
 async def get_sha1_ahashs(sha1s: list[str] = None):
-    t = Table('computed_values')
-    query = Query.from_(t).select('sha1', 'ahash')
+    query = 'SELECT sha1, ahash FROM computed_values'
     if sha1s:
-        query = query.where(t.sha1.isin(sha1s))
-    cursor = await execute_query(query.get_sql())
-    rows = await cursor.fetchall()
+        rows = await fetch_in_chunks(query + ' WHERE sha1 IN ({values})', list(set(sha1s)))
+    else:
+        cursor = await execute_query(query)
+        rows = await cursor.fetchall()
     res = {row[0]: row[1] for row in rows}
     return res
 
 
 async def get_sha1_computed_values(sha1s: list[str] = None):
-    t = Table('computed_values')
-    # select query should be in same order as the dataclass model properties
-    query = Query.from_(t).select('sha1', 'ahash', 'vector')
+    """
+    Computed values with their vector read from the vector store. Vectors are views on the store, prefer get_vectors
+    when only vectors are needed
+    """
+    store = get_store()
+    query = 'SELECT sha1, ahash, id FROM computed_values'
     if sha1s:
-        query = query.where(t.sha1.isin(sha1s))
-    cursor = await execute_query(query.get_sql())
-    rows = await cursor.fetchall()
-    res = [ComputedValue(*row) for row in rows]
+        rows = await fetch_in_chunks(query + ' WHERE sha1 IN ({values})', list(set(sha1s)), key=lambda row: row[2])
+    else:
+        cursor = await execute_query(query)
+        rows = await cursor.fetchall()
+    # values whose vector was never written are considered as not computed
+    written = store.has_rows([row[2] for row in rows])
+    res = [ComputedValue(sha1, ahash, store.row(id_), id_) for (sha1, ahash, id_), ok in zip(rows, written) if ok]
     return res
+
+
+async def get_vectors(sha1s: list[str]) -> tuple[list[str], np.ndarray]:
+    """
+    Matrix of the vectors of the given sha1s in their order, sha1s without vector are skipped
+    """
+    ids = dict(await fetch_in_chunks("SELECT sha1, id FROM computed_values WHERE sha1 IN ({values})",
+                                     list(set(sha1s))))
+    found = [sha1 for sha1 in sha1s if sha1 in ids]
+    store = get_store()
+    written = store.has_rows([ids[sha1] for sha1 in found])
+    found = [sha1 for sha1, ok in zip(found, written) if ok]
+    return found, store.get_rows([ids[sha1] for sha1 in found])
+
+
+async def get_used_computed_ids() -> tuple[list[int], list[str]]:
+    """
+    Ids and sha1s of the computed values still used by at least one image, sorted by id
+    """
+    query = """
+            SELECT id, sha1 FROM computed_values
+            WHERE sha1 IN (SELECT sha1 FROM images)
+            ORDER BY id
+        """
+    cursor = await execute_query(query)
+    rows = await cursor.fetchall()
+    rows = [row for row, ok in zip(rows, get_store().has_rows([row[0] for row in rows])) if ok]
+    if not rows:
+        return [], []
+    ids, sha1s = zip(*rows)
+    return list(ids), list(sha1s)
@@ -1,54 +1,355 @@
+import asyncio
 import json
 import os
 import sqlite3
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from contextvars import ContextVar
 from json import JSONDecodeError
+from typing import Callable
 
 import aiosqlite
 import numpy as np
+import orjson
 
-ALL_TABLES = ['images', 'property_values', 'properties', 'tags', 'folders', 'tabs']
+from panoptic.core import vector_store, thumbnails
+from panoptic.core.tag_graph import invalidate_tag_graph
+
+ALL_TABLES = ['images', 'property_values', 'properties', 'tags', 'folders', 'tabs', 'image_files', 'image_tags']
 
 aiosqlite.register_adapter(np.array, lambda arr: arr.tobytes())
 aiosqlite.register_converter("array", lambda arr: np.frombuffer(arr, dtype='float32'))
 
+# all writes go through the single writer connection, reads are spread over read only connections so that
+# browsing isn't queued behind an import or a large deletion. WAL lets readers run while the writer writes
 conn: aiosqlite.Connection | None = None
+readers: list[aiosqlite.Connection] = []
+nb_readers = int(os.getenv('PANOPTIC_DB_READERS', 4))
+
+PRAGMAS = {
+    'synchronous': 'NORMAL',
+    # negative sizes are in KiB: 64MB of page cache per connection
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+# statements are compiled once per connection and reused, queries are built with a fixed shape for that
+CACHED_STATEMENTS = 512
+
+# queries are serialized so that a transaction opened by a task is never committed by another one
+_lock = asyncio.Lock()
+_in_transaction: ContextVar[bool] = ContextVar('in_transaction', default=False)
+# callbacks to run once the current transaction is over
+_after_transaction: ContextVar[list[Callable] | None] = ContextVar('after_transaction', default=None)
+_next_reader = 0
+_snapshot_reader: ContextVar[aiosqlite.Connection | None] = ContextVar('snapshot_reader', default=None)
+_reader_locks: dict[aiosqlite.Connection, asyncio.Lock] = {}
 
 
 async def init():
-    global conn
-    conn = await aiosqlite.connect(os.path.join(os.environ['PANOPTIC_DATA'], "panoptic.db"), detect_types=sqlite3.PARSE_DECLTYPES)
-    await create_tables_if_db_empty()
+    global conn, readers, _reader_locks
+    await close()
+    invalidate_tag_graph()
+    path = os.path.join(os.environ['PANOPTIC_DATA'], "panoptic.db")
+    conn = await aiosqlite.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=CACHED_STATEMENTS)
+    await conn.execute('PRAGMA journal_mode=WAL')
+    await _set_pragmas(conn)
+    await create_tables()
+    await fill_image_tags()
+    readers = [await _connect_reader(path) for _ in range(nb_readers)]
+    _reader_locks = {reader: asyncio.Lock() for reader in readers}
+    vector_store.open_store(os.environ['PANOPTIC_DATA'])
+    thumbnails.open_store(os.environ['PANOPTIC_DATA'])
+    await asyncio.to_thread(thumbnails.compact_stores)
+    await move_vectors_to_store()
+
+
+async def _connect_reader(path: str) -> aiosqlite.Connection:
+    reader = await aiosqlite.connect(f'file:{path}?mode=ro', uri=True, detect_types=sqlite3.PARSE_DECLTYPES,
+                                     cached_statements=CACHED_STATEMENTS)
+    await reader.execute('PRAGMA query_only=ON')
+    await _set_pragmas(reader)
+    return reader
+
+
+async def _set_pragmas(connection: aiosqlite.Connection):
+    for name, value in PRAGMAS.items():
+        await connection.execute(f'PRAGMA {name}={value}')
+
+
+async def close():
+    global conn, readers
+    if conn is not None:
+        await conn.close()
+    [await reader.close() for reader in readers]
+    conn = None
+    readers = []
+
+
+async def create_tables():
+    """
+    The creation script only creates missing tables and indexes, so that projects created with an
+    older version of panoptic get the new ones
+    """
+    with open(os.path.join(os.path.dirname(__file__), '../scripts', 'create_db.sql'), 'r') as f:
+        sql_script = f.read()
+        await conn.executescript(sql_script)
+        await conn.commit()
+    await _add_computed_values_id()
+
 
+async def _add_computed_values_id():
+    """
+    computed_values used to be keyed by sha1 only, the implicit rowid served as id.
+    The table is rebuilt with an explicit id that keeps the value of the rowid
+    """
+    cursor = await conn.execute('PRAGMA table_info(computed_values)')
+    if 'id' in [row[1] for row in await cursor.fetchall()]:
+        return
+    await conn.executescript("""
+        BEGIN;
+        CREATE TABLE computed_values_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sha1 TEXT NOT NULL UNIQUE,
+            ahash TEXT,
+            vector ARRAY
+        );
+        INSERT INTO computed_values_new (id, sha1, ahash, vector)
+            SELECT rowid, sha1, ahash, vector FROM computed_values;
+        DROP TABLE computed_values;
+        ALTER TABLE computed_values_new RENAME TO computed_values;
+        CREATE INDEX idx_computed_values_vector ON computed_values (sha1) WHERE vector IS NOT NULL;
+        COMMIT;
+    """)
 
-async def create_tables_if_db_empty():
-    query = "SELECT name FROM sqlite_master WHERE type='table'"
-    cursor = await execute_query(query)
-    all_tables = await cursor.fetchall()
-    if len(list(all_tables)) < len(ALL_TABLES):
-        with open(os.path.join(os.path.dirname(__file__), '../scripts', 'create_db.sql'), 'r') as f:
-            sql_script = f.read()
-            async with conn.executescript(sql_script) as cursor:
-                await conn.commit()
+
+@asynccontextmanager
+async def transaction():
+    """
+    All queries executed inside this context are committed together at the end, or rolled back on error
+    """
+    if _in_transaction.get():
+        yield
+        return
+    async with _lock:
+        token = _in_transaction.set(True)
+        callbacks_token = _after_transaction.set([])
+        try:
+            await conn.execute('BEGIN')
+            yield
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+        finally:
+            callbacks = _after_transaction.get()
+            _after_transaction.reset(callbacks_token)
+            _in_transaction.reset(token)
+            [callback() for callback in callbacks]
+
+
+def in_transaction() -> bool:
+    return _in_transaction.get()
+
+
+def after_transaction(callback: Callable):
+    """
+    Call callback once the current transaction is committed or rolled back, right away outside of a transaction.
+    Caches of the database are invalidated this way, they could otherwise be loaded again from uncommitted data
+    """
+    callbacks = _after_transaction.get()
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+
+async def fill_image_tags():
+    """
+    image_tags is filled by triggers, the tags set before it existed are added once when it is empty
+    """
+    cursor = await conn.execute("SELECT EXISTS (SELECT 1 FROM image_tags)")
+    if (await cursor.fetchone())[0]:
+        return
+    query = """
+            INSERT OR IGNORE INTO image_tags (property_id, image_id, sha1, tag_id)
+            SELECT pv.property_id, pv.image_id, pv.sha1, j.value
+            FROM property_values pv JOIN properties p ON p.id = pv.property_id,
+                 json_each(CASE WHEN json_valid(pv.value) THEN CASE json_type(pv.value) WHEN 'array' THEN pv.value END END) j
+            WHERE p.type IN ('tag', 'multi_tags')
+        """
+    await execute_query(query)
+
+
+async def move_vectors_to_store(chunk_size=10000):
+    """
+    Vectors used to be stored as blobs in computed_values, move them to the vector store.
+    The partial index on the vectors left in the table makes this a single lookup once they are all moved
+    """
+    store = vector_store.get_store()
+    while True:
+        query = "SELECT id, sha1, vector FROM computed_values WHERE vector IS NOT NULL LIMIT ?"
+        cursor = await execute_query(query, (chunk_size,))
+        rows = await cursor.fetchall()
+        if not rows:
+            return
+        ids, sha1s, vectors = zip(*rows)
+        store.write(list(ids), np.asarray(vectors))
+        await execute_query_many("UPDATE computed_values SET vector = NULL WHERE id = ?", [(id_,) for id_ in ids])
 
 
 # Fonction utilitaire pour exécuter une requête SQL et commettre les modifications
+# les SELECT sont envoyés à une connexion de lecture
 async def execute_query(query: str, parameters: tuple = None):
-    cursor = await conn.cursor()
+    if _is_read(query):
+        return await execute_read(query, parameters)
+    if _in_transaction.get():
+        return await _execute(query, parameters)
+    async with _lock:
+        cursor = await _execute(query, parameters)
+        await conn.commit()
+        return cursor
+
+
+async def execute_read(query: str, parameters: tuple = None):
+    """
+    Execute a read only query on one of the reader connections, the one of the snapshot when there is one.
+    Inside a transaction the writer is used so that the query sees the uncommitted changes
+    """
+    if _in_transaction.get() or not readers:
+        return await _execute(query, parameters)
+    reader = _snapshot_reader.get() or _pick_reader()
+    return await _execute(query, parameters, reader)
+
+
+def _pick_reader() -> aiosqlite.Connection:
+    global _next_reader
+    reader = readers[_next_reader % len(readers)]
+    _next_reader += 1
+    return reader
+
+
+@asynccontextmanager
+async def read_snapshot():
+    """
+    All the reads executed inside this context see the same state of the database: they run on one reader,
+    in a read transaction. The readers would otherwise each see the last commit made when they started reading
+    """
+    if _in_transaction.get() or _snapshot_reader.get() is not None or not readers:
+        yield
+        return
+    reader = _pick_reader()
+    # only one snapshot at a time on a reader, its transaction is shared by all the queries of the connection
+    async with _reader_locks[reader]:
+        token = _snapshot_reader.set(reader)
+        try:
+            await reader.execute('BEGIN')
+            yield
+        finally:
+            _snapshot_reader.reset(token)
+            await reader.commit()
+
+
+def _is_read(query: str):
+    return query.lstrip()[:6].upper() == 'SELECT'
+
+
+async def _execute(query: str, parameters: tuple = None, connection: aiosqlite.Connection = None):
+    cursor = await (connection or conn).cursor()
     if parameters:
         await cursor.execute(query, parameters)
     else:
         await cursor.execute(query)
-    await conn.commit()
     return cursor
 
+
 async def execute_query_many(query, data: list):
+    if _in_transaction.get():
+        return await _execute_many(query, data)
+    async with _lock:
+        cursor = await _execute_many(query, data)
+        await conn.commit()
+        return cursor
+
+
+async def _execute_many(query, data: list):
     cursor = await conn.cursor()
     await cursor.executemany(query, data)
-    await conn.commit()
     return cursor
 
 
+# stays under SQLITE_MAX_VARIABLE_NUMBER, which is 999 on older SQLite builds
+MAX_VARIABLES = 900
+
+
+async def fetch_in_chunks(query: str, values: list, params: tuple = (), chunk_size=MAX_VARIABLES,
+                          key: Callable = None) -> list[tuple]:
+    """
+    Fetch the rows of a query filtered by a large list of values. Each {values} in the query is replaced by
+    the placeholders of a chunk of values, bound after params. All the chunks are read from the same snapshot.
+    The rows of the chunks are returned in order, or sorted by key when it is given
+    """
+    rows = []
+    async with read_snapshot():
+        for chunk_query, chunk_params in _chunks(query, values, params, chunk_size):
+            cursor = await execute_query(chunk_query, chunk_params)
+            rows.extend(await cursor.fetchall())
+    if key is not None:
+        rows.sort(key=key)
+    return rows
+
+
+async def execute_in_chunks(query: str, values: list, params: tuple = (), chunk_size=MAX_VARIABLES):
+    """
+    Same as fetch_in_chunks for a query that modifies the database, all the chunks are executed in one transaction
+    """
+    async with transaction():
+        for chunk_query, chunk_params in _chunks(query, values, params, chunk_size):
+            await execute_query(chunk_query, chunk_params)
+
+
+def _chunks(query: str, values: list, params: tuple, chunk_size: int):
+    count = query.count('{values}')
+    chunk_size = max(1, (chunk_size - len(params) * count) // count)
+    for i in range(0, len(values), chunk_size):
+        chunk = tuple(values[i:i + chunk_size])
+        # chunks are padded with their last value to a power of two (or the chunk size) so that only a few
+        # statement shapes exist and their compiled version is reused. A value repeated in IN changes nothing
+        size = min(chunk_size, 1 << (len(chunk) - 1).bit_length())
+        chunk += chunk[-1:] * (size - len(chunk))
+        yield in_query(query, size), (params + chunk) * count
+
+
+@lru_cache(maxsize=256)
+def in_query(query: str, nb_values: int) -> str:
+    """
+    The query with each {values} replaced by nb_values placeholders
+    """
+    return query.replace('{values}', ','.join('?' * nb_values))
+
+
+async def insert_many(table: str, query: str, data: list) -> list[int]:
+    """
+    Insert all rows with a single executemany in one transaction and return their ids.
+    Only works for AUTOINCREMENT tables: the ids given to the rows are the ones following
+    the table sequence, which can't be moved by another query during the transaction
+    """
+    if not data:
+        return []
+    async with transaction():
+        await execute_query_many(query, data)
+        cursor = await execute_query("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,))
+        last_id = (await cursor.fetchone())[0]
+    return list(range(last_id - len(data) + 1, last_id + 1))
+
+
 def decode_if_json(value):
+    # orjson is much faster, json is still used for what it doesn't accept (NaN, very large integers)
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        pass
     try:
         return json.loads(value)
     except (TypeError, JSONDecodeError, UnicodeDecodeError):
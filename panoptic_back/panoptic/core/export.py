@@ -0,0 +1,113 @@
+import csv
+import io
+import zlib
+from typing import AsyncIterator
+
+from panoptic.models import PropertyType
+
+FORMATS = {
+    'csv': ('text/csv', 'export.csv'),
+    'csv.gz': ('application/gzip', 'export.csv.gz'),
+    'parquet': ('application/vnd.apache.parquet', 'export.parquet'),
+}
+
+
+async def to_csv(columns: list[str], pages: AsyncIterator[list[list]]) -> AsyncIterator[bytes]:
+    """
+    Encode the rows in csv as they are produced, one chunk per page
+    """
+    buff = io.StringIO()
+    writer = csv.writer(buff, delimiter=';', lineterminator='\n')
+    writer.writerow(columns)
+    async for rows in pages:
+        writer.writerows(rows)
+        yield buff.getvalue().encode()
+        buff.seek(0)
+        buff.truncate()
+    if buff.tell():
+        yield buff.getvalue().encode()
+
+
+async def to_gzip(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    # wbits=31 writes the gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+async def to_parquet(columns: list[str], types: list[PropertyType | None],
+                     pages: AsyncIterator[list[list]]) -> AsyncIterator[bytes]:
+    """
+    Each page is written as a row group, the bytes of the file are sent as soon as a group is written.
+    Needs pyarrow
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(name, _arrow_type(pa, prop_type)) for name, prop_type in zip(columns, types)])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema)
+    try:
+        async for rows in pages:
+            arrays = [pa.array([_to_arrow_value(row[i], prop_type) for row in rows], type=field.type)
+                      for i, (field, prop_type) in enumerate(zip(schema, types))]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def _arrow_type(pa, prop_type: PropertyType | None):
+    if prop_type == PropertyType.number:
+        return pa.float64()
+    if prop_type == PropertyType.checkbox:
+        return pa.bool_()
+    return pa.string()
+
+
+def _to_arrow_value(value, prop_type: PropertyType | None):
+    if value is None or value == '':
+        return None
+    if prop_type == PropertyType.number:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+    if prop_type == PropertyType.checkbox:
+        return bool(value)
+    return str(value)
+
+
+class _ChunkSink:
+    """
+    Write only file keeping the bytes written since the last drain. The position keeps counting all the bytes
+    written, parquet stores offsets from the start of the file
+    """
+    def __init__(self):
+        self.closed = False
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
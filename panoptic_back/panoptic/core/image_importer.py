@@ -4,16 +4,20 @@ from concurrent.futures import Executor
 from pathlib import Path
 from typing import List
 
-from panoptic.core import db
+from panoptic.core import db, thumbnails
+from panoptic.core.import_events import ImportEvents
 from panoptic.core.process_queue import ImportImageQueue, ComputeVectorsQueue
-from panoptic.models import Folder, ImageImportTask, Image, ComputedValue
+from panoptic.models import Folder, ImageImportTask, ComputedValue, DecodedImage
 from panoptic.scripts.create_faiss_index import compute_faiss_index
 
 
 class ImageImporter:
-    def __init__(self, executor: Executor):
+    def __init__(self, executor: Executor, embedding_executor: Executor, batch_size=32, batch_timeout=0.5,
+                 import_workers=6, import_batch_size=16):
         self.status = 'read'
         self.executor = executor
+        self.embedding_executor = embedding_executor
+        self.import_workers = import_workers
 
         self.total_import = 0
         self.current_import = 0
@@ -23,22 +27,48 @@ class ImageImporter:
 
         # self._final_callback = None
 
-        self._import_queue = ImportImageQueue(executor)
-        self._compute_queue = ComputeVectorsQueue(executor)
+        # all the files are queued at once, a batch takes the ones available without waiting for more
+        self._import_queue = ImportImageQueue(executor, batch_size=import_batch_size, flush_timeout=0)
+        # decoded images wait here for the vectorization stage, the bound keeps the pixels held in memory small
+        self._compute_queue = ComputeVectorsQueue(embedding_executor, batch_size=batch_size,
+                                                  flush_timeout=batch_timeout, maxsize=batch_size * 4)
         self._pca_task: asyncio.Task | None = None
+        # an index update is waiting for the queues to be drained
+        self._index_waiting = False
+        self._requeue_task: asyncio.Task | None = None
         self._auto_pca = False
 
         self._new_images = []
+        # progress pushed to the clients listening to the import events
+        self.events = ImportEvents()
     # def _reset_counters(self):
     #     self.total_import = -1
     #     self.current_import = 0
 
+    def get_worker_stats(self):
+        return list(self._compute_queue.worker_stats.values())
+
     def get_new_images(self):
         copy = [id_ for id_ in self._new_images]
         self._new_images.clear()
         return copy
 
-    async def import_folder(self, folder: str):
+    async def import_folder(self, folder: str) -> int:
+        """
+        Import the images of the folder that were never imported, returns the number of new images
+        """
+        diff = await self._import(folder, sync=False)
+        return diff['added']
+
+    async def sync_folder(self, folder: str) -> dict[str, int]:
+        """
+        Incremental import: new files are imported, files whose size, modification time or inode changed
+        are imported again and removed files are deleted from the project.
+        Returns the number of added, modified, removed and unchanged files
+        """
+        return await self._import(folder, sync=True)
+
+    async def _import(self, folder: str, sync: bool) -> dict[str, int]:
         if self.total_import == self.current_import:
             self.total_compute = 0
             self.current_computed = 0
@@ -47,38 +77,117 @@ class ImageImporter:
 
         self._auto_pca = False
 
-        all_files = [os.path.join(path, name) for path, subdirs, files in os.walk(folder) for name in files]
-        all_images = [i for i in all_files if
-                      i.lower().endswith('.png') or i.lower().endswith('.jpg') or i.lower().endswith('.jpeg')]
-        self.total_import += len(all_images)
-        self.total_compute += len(all_images)
-
-        folder_node, file_to_folder_id = await compute_folder_structure(folder, all_images)
+        files = await asyncio.to_thread(scan_folder, folder)
+
+        folder_node, file_to_folder_id = await compute_folder_structure(folder, list(files))
+        keys = {file: _file_key(file, file_to_folder_id[file]) for file in files}
+
+        # files already imported are skipped before entering the queue, only their missing vectors are computed
+        known_files = await db.get_folder_tree_files(folder)
+        new_images = [file for file in files if keys[file] not in known_files]
+        modified_images = []
+        removed = []
+        # files imported before fingerprints were stored can't be compared, they are only fingerprinted
+        await db.set_image_files([(*keys[file], *files[file]) for file in files
+                                  if keys[file] in known_files and known_files[keys[file]][0] is None])
+        if sync:
+            modified_images = [file for file in files if keys[file] in known_files
+                               and known_files[keys[file]][0] is not None and known_files[keys[file]] != files[file]]
+            on_disk = set(keys.values())
+            removed = [key for key in known_files if key not in on_disk]
+            if removed:
+                old_sha1s = await db.delete_image_files(removed)
+                thumbnails.discard(await db.delete_unused_computed_values(old_sha1s))
+        uncomputed = await db.get_folder_tree_uncomputed_images(folder)
+
+        self.total_import += len(new_images) + len(modified_images)
+        self.total_compute += len(new_images) + len(modified_images) + len(uncomputed)
 
         self.status = 'compute'
+        self.events.publish()
 
-        def on_import(image: Image, is_last):
+        async def on_import(image: DecodedImage, is_last):
             self.current_import += 1
-            self._compute_queue.add_task(image.id)
-
-            if self._import_queue.done():
-                self._compute_queue.start_workers(6)
+            self.events.publish(new_images=[image.image_id])
+            await self._compute_queue.put_task(image)
 
         def on_compute(vector: ComputedValue, is_last):
             self.current_computed += 1
-            if is_last:
-                # print('would run pca now')
-                self._pca_task = asyncio.create_task(compute_faiss_index())
+            self.events.publish()
 
         self._import_queue.done_callback = on_import
         self._compute_queue.done_callback = on_compute
 
-        tasks = [ImageImportTask(folder_id=file_to_folder_id[file], image_path=file) for file in all_images]
+        tasks = [ImageImportTask(folder_id=file_to_folder_id[file], image_path=file, fingerprint=files[file])
+                 for file in new_images]
+        tasks += [ImageImportTask(folder_id=file_to_folder_id[file], image_path=file, fingerprint=files[file],
+                                  replace=True) for file in modified_images]
         [self._import_queue.add_task(t) for t in tasks]
 
-        self._import_queue.start_workers(6)
-
-        return len(all_images)
+        self._import_queue.start_workers(self.import_workers)
+        self._compute_queue.start_workers(6)
+
+        if uncomputed:
+            self._requeue_task = asyncio.create_task(
+                self._queue_uncomputed([DecodedImage(id_, sha1) for id_, sha1 in uncomputed]))
+        # when nothing is computed the similarity index still has to forget removed images
+        if (tasks or uncomputed or removed) and not self._index_waiting:
+            self._index_waiting = True
+            self._pca_task = asyncio.create_task(self._update_index_when_done(self._pca_task))
+
+        return {
+            'added': len(new_images),
+            'modified': len(modified_images),
+            'removed': len(removed),
+            'unchanged': len(files) - len(new_images) - len(modified_images)
+        }
+
+    async def _update_index_when_done(self, previous: asyncio.Task | None):
+        """
+        Update the similarity index once both stages are drained. Images of an import started meanwhile are waited
+        for too, the index is only updated once
+        """
+        try:
+            await self._import_queue.join()
+            # images imported before are queued again by this task, their vectors are computed after it ends
+            if self._requeue_task:
+                await self._requeue_task
+            await self._compute_queue.join()
+        finally:
+            self._index_waiting = False
+        if previous is not None and not previous.done():
+            await asyncio.wait([previous])
+        await compute_faiss_index()
+        self.events.publish(index_rebuilt=True)
+
+    async def _queue_uncomputed(self, images: List[DecodedImage]):
+        for image in images:
+            await self._compute_queue.put_task(image)
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def scan_folder(root_path: str) -> dict[str, tuple[int, int, int]]:
+    """
+    Recursively list the images of a folder with their (size, mtime, inode) fingerprint
+    """
+    files = {}
+    directories = [root_path]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_size, stat.st_mtime_ns, entry.inode())
+    return files
+
+
+def _file_key(file_path: str, folder_id: int):
+    name = file_path.split(os.sep)[-1]
+    return folder_id, name, name.split('.')[-1]
 
 
 async def compute_folder_structure(root_path, all_files: List[str]):
@@ -0,0 +1,52 @@
+import asyncio
+
+
+class ImportSubscriber:
+    """
+    What happened during the import since the last time the subscriber was drained
+    """
+    def __init__(self):
+        self.changed = asyncio.Event()
+        self.new_images: list[int] = []
+        self.index_rebuilt = False
+
+    async def wait(self, timeout: float) -> bool:
+        """
+        Wait for a change, returns False when nothing changed before the timeout
+        """
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def drain(self) -> tuple[list[int], bool]:
+        new_images, index_rebuilt = self.new_images, self.index_rebuilt
+        self.new_images, self.index_rebuilt = [], False
+        self.changed.clear()
+        return new_images, index_rebuilt
+
+
+class ImportEvents:
+    """
+    Pushes the progress of the import to the subscribers instead of letting them poll.
+    Publishing only marks the subscribers as changed, events are built by the subscribers at their own pace so that
+    all the changes made meanwhile are sent together
+    """
+    def __init__(self):
+        self._subscribers: set[ImportSubscriber] = set()
+
+    def subscribe(self) -> ImportSubscriber:
+        subscriber = ImportSubscriber()
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: ImportSubscriber):
+        self._subscribers.discard(subscriber)
+
+    def publish(self, new_images: list[int] = None, index_rebuilt=False):
+        for subscriber in self._subscribers:
+            if new_images:
+                subscriber.new_images.extend(new_images)
+            subscriber.index_rebuilt |= index_rebuilt
+            subscriber.changed.set()
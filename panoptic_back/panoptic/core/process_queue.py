@@ -1,27 +1,33 @@
 import asyncio
 import gc
 import hashlib
+import inspect
 import logging
 import os
 import sys
+import time
 import traceback
+from abc import ABC, abstractmethod
 from concurrent.futures import Executor
 from typing import List, Callable, Dict
 
 from PIL import Image
 
 import panoptic.compute as compute
-from panoptic.core import db
-from panoptic.models import ImageImportTask
+from panoptic.compute.worker import compute_vectors, compute_images
+from panoptic.core import db, thumbnails
+from panoptic.core.db_utils import transaction
+from panoptic.models import ImageImportTask, ComputedValue, DecodedImage
 
 logger = logging.getLogger('ProcessQueue')
 
 
-class ProcessQueue:
-    def __init__(self, executor: Executor):
+class ProcessQueue(ABC):
+    def __init__(self, executor: Executor, maxsize=0):
         self.executor = executor
 
-        self._queue = asyncio.Queue()
+        # when maxsize is set, put_task waits for a free slot so that producers can't run too far ahead
+        self._queue = asyncio.Queue(maxsize)
         self._workers: List[asyncio.Task] = []
         self._working: Dict[int, bool] = {}
         self.done_callback = None
@@ -35,9 +41,18 @@ class ProcessQueue:
     def add_task(self, task):
         self._queue.put_nowait(task)
 
+    async def put_task(self, task):
+        await self._queue.put(task)
+
     def done(self):
         return self._queue.qsize() == 0
 
+    async def join(self):
+        """
+        Wait until every task put in the queue was processed, including the ones that failed
+        """
+        await self._queue.join()
+
     async def _process_queue(self, worker_id: int):
         while True:
             try:
@@ -49,49 +64,152 @@ class ProcessQueue:
                 # set working flag
                 self._working[worker_id] = True
 
-                res = await self._process_task(task)
-                if self.done_callback:
+                try:
+                    res = await self._process_task(task)
+                    if self.done_callback:
 
-                    is_last = self.done() and self.get_working_nb() == 1
-                    self.done_callback(res, is_last)
+                        is_last = self.done() and self.get_working_nb() == 1
+                        await self._call_done_callback(res, is_last)
+                finally:
+                    # failed tasks count as done too, join doesn't wait for them forever
+                    self._queue.task_done()
             except Exception as e:
                 exc_type, exc_value, exc_traceback = sys.exc_info()
                 logger.error("".join(traceback.format_exception(exc_type, exc_value, exc_traceback)))
                 logger.error(e)
 
+    async def _call_done_callback(self, res, is_last):
+        callback_res = self.done_callback(res, is_last)
+        if inspect.isawaitable(callback_res):
+            await callback_res
+
+    def idle(self):
+        return self.done() and self.get_working_nb() == 0
+
     def get_working_nb(self):
         working = [v for v in self._working.values() if v]
         return len(working)
 
+    @abstractmethod
     async def _process_task(self, task):
-        raise NotImplementedError()
+        ...
 
     async def _execute_in_process(self, fnc: Callable, *args):
         return await asyncio.wrap_future(self.executor.submit(fnc, *args))
 
 
-class ImportImageQueue(ProcessQueue):
+class BatchProcessQueue(ProcessQueue):
+    """
+    ProcessQueue that hands tasks to _process_batch by micro-batches of at most batch_size tasks.
+    A partial batch is flushed when no new task arrived during flush_timeout seconds
+    """
+    def __init__(self, executor: Executor, batch_size=32, flush_timeout=0.5, maxsize=0):
+        super().__init__(executor, maxsize)
+        self.batch_size = batch_size
+        self.flush_timeout = flush_timeout
+
+    async def _next_batch(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.flush_timeout
+        while len(batch) < self.batch_size:
+            if not self.done():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _process_queue(self, worker_id: int):
+        while True:
+            try:
+                if self.done():
+                    self._working[worker_id] = False
+
+                batch = await self._next_batch()
+                self._working[worker_id] = True
+
+                try:
+                    results = await self._process_batch(batch)
+                    if self.done_callback:
+                        for i, res in enumerate(results):
+                            is_last = i == len(results) - 1 and self.done() and self.get_working_nb() == 1
+                            await self._call_done_callback(res, is_last)
+                finally:
+                    [self._queue.task_done() for _ in batch]
+            except Exception as e:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                logger.error("".join(traceback.format_exception(exc_type, exc_value, exc_traceback)))
+                logger.error(e)
+
+    async def _process_task(self, task):
+        return (await self._process_batch([task]))[0]
+
+    @abstractmethod
+    async def _process_batch(self, tasks: list) -> list:
+        ...
+
+
+class ImportImageQueue(BatchProcessQueue):
+    """
+    Files are decoded in parallel by the executor, the rows of a batch are written together in one transaction
+    """
     def add_task(self, task: ImageImportTask):
         super().add_task(task)
 
-    async def _process_task(self, task: ImageImportTask):
-        # print('process: ', task.image_path, task.folder_id)
-        name = task.image_path.split(os.sep)[-1]
-        extension = name.split('.')[-1]
-        folder_id = task.folder_id
-
-        db_image = await db.has_image_file(folder_id, name, extension)
-        if db_image:
-            return db_image
+    async def _process_batch(self, tasks: list[ImageImportTask]) -> list[DecodedImage]:
+        results = await asyncio.gather(*[self._execute_in_process(self._import_image, task.image_path)
+                                         for task in tasks], return_exceptions=True)
+        decoded = []
+        for task, res in zip(tasks, results):
+            if isinstance(res, Exception):
+                logger.error(f'could not import {task.image_path}: {res}')
+                continue
+            decoded.append((task, res))
+            sha1, tiers = res[0], res[6]
+            # the packs are only written by the main process, the thumbnails are stored before the image refers to them
+            for size, data in tiers.items():
+                thumbnails.get_tier_store(size).put(sha1, data)
 
-        sha1, url, width, height = await self._execute_in_process(self._import_image, task.image_path)
+        image_ids = {}
+        old_sha1s = set()
+        async with transaction():
+            to_add = []
+            for task, (sha1, url, width, height, *_) in decoded:
+                folder_id, name, extension = self._file_key(task)
+                if task.replace:
+                    ids, replaced = await db.update_image_file(folder_id, name, extension, sha1, width, height)
+                    old_sha1s.update(replaced)
+                    # the image was removed while its file was decoded, it is imported again
+                    if ids:
+                        image_ids[task.image_path] = ids[0]
+                        continue
+                to_add.append((task, (folder_id, name, extension, sha1, url, width, height)))
+            ids = await db.add_images([row for _, row in to_add])
+            image_ids.update({task.image_path: id_ for (task, _), id_ in zip(to_add, ids)})
+            await db.set_image_files([(*self._file_key(task), *task.fingerprint) for task, _ in decoded
+                                      if task.fingerprint])
+            # the previous content of the modified files leaves nothing behind once no other image uses it
+            discarded = await db.delete_unused_computed_values(list(old_sha1s))
+        thumbnails.discard(discarded)
+        return [DecodedImage(image_ids[task.image_path], sha1, ahash, pixels)
+                for task, (sha1, url, width, height, ahash, pixels, tiers) in decoded]
 
-        image = await db.add_image(folder_id, name, extension, sha1, url, width, height)
-        # print(f'imported image: {image.id} : {image.sha1}')
-        return image
+    @staticmethod
+    def _file_key(task: ImageImportTask) -> tuple[int, str, str]:
+        name = task.image_path.split(os.sep)[-1]
+        return task.folder_id, name, name.split('.')[-1]
 
     @staticmethod
     def _import_image(file_path):
+        """
+        Decode the file once and compute everything the next stages need from it:
+        sha1, size, average hash, the resized pixels used by the model and the thumbnails made at import
+        """
         image = Image.open(file_path)
         width, height = image.size
         sha1_hash = hashlib.sha1(image.tobytes()).hexdigest()
@@ -99,43 +217,58 @@ class ImportImageQueue(ProcessQueue):
         # url = os.path.join('/static/' + file_path.split(os.getenv('PANOPTIC_ROOT'))[1].replace('\\', '/'))
         url = f"/images/{file_path}"
         image = image.convert('RGB')
-        mini = image.copy()
-        mini.thumbnail(size=(200, 200))
-        mini.save(os.path.join(os.environ['PANOPTIC_DATA'], "mini", sha1_hash + '.jpeg'), optimize=True, quality=30)
+        ahash = str(compute.to_average_hash(image))
+        pixels = compute.to_model_input(image)
+        tiers = thumbnails.make_tiers(image, thumbnails.IMPORT_TIERS)
 
         del image
-        del mini
         # gc.collect()
 
-        return sha1_hash, url, width, height
+        return sha1_hash, url, width, height, ahash, pixels, tiers
 
 
-class ComputeVectorsQueue(ProcessQueue):
-    async def _process_task(self, task):
-        image_id: int = task
-        image = (await db.get_images(ids=[image_id]))[0]
-        computed = await db.get_sha1_computed_values([image.sha1])
-        if computed:
-            return computed
-
-        folder = await db.get_folder(image.folder_id)
-        file_path = f"{folder.path}/{image.name}"
-        ahash, vector = await self._execute_in_process(self.compute_image, file_path)
-        res = await db.set_computed_value(sha1=image.sha1, ahash=ahash, vector=vector)
-        del vector
-        # gc.collect()
-        print('computed image: ', image_id, '  :  ', res.sha1)
-        return res
+class ComputeVectorsQueue(BatchProcessQueue):
+    def __init__(self, executor: Executor, batch_size=32, flush_timeout=0.5, maxsize=0):
+        super().__init__(executor, batch_size, flush_timeout, maxsize)
+        # last stats reported by each embedding worker, indexed by process and thread
+        self.worker_stats: Dict[str, dict] = {}
 
-    @staticmethod
-    def compute_image(image_path: str):
-        image = Image.open(image_path)
-        image = image.convert('RGB')
-        ahash = str(compute.to_average_hash(image))
-        # TODO: find a way to access all the images for PCA
-        vector = compute.to_vector(image)
+    async def _process_batch(self, tasks: list[DecodedImage]) -> list[ComputedValue]:
+        computed = {c.sha1: c for c in await db.get_sha1_computed_values(list({t.sha1 for t in tasks}))}
 
-        del image
-        # gc.collect()
+        # only compute each sha1 once, clones and duplicates share the same vector
+        decoded: dict[str, DecodedImage] = {}
+        to_read: dict[str, int] = {}
+        for task in tasks:
+            if task.sha1 in computed or task.sha1 in decoded or task.sha1 in to_read:
+                continue
+            if task.pixels is not None:
+                decoded[task.sha1] = task
+            else:
+                to_read[task.sha1] = task.image_id
+
+        values = []
+        if decoded:
+            vectors, stats = await self._execute_in_process(compute_vectors,
+                                                            [t.pixels for t in decoded.values()])
+            self.worker_stats[stats['worker']] = stats
+            values.extend(ComputedValue(t.sha1, t.ahash, vector) for t, vector in zip(decoded.values(), vectors))
+
+        # images that were already imported before have to be read again from their file
+        if to_read:
+            images = await db.get_images(ids=list(to_read.values()))
+            folders = {}
+            for image in images:
+                if image.folder_id not in folders:
+                    folders[image.folder_id] = await db.get_folder(image.folder_id)
+            paths = [f"{folders[img.folder_id].path}/{img.name}" for img in images]
+            ahashs, vectors, stats = await self._execute_in_process(compute_images, paths)
+            self.worker_stats[stats['worker']] = stats
+            values.extend(ComputedValue(img.sha1, ahash, vector)
+                          for img, ahash, vector in zip(images, ahashs, vectors) if ahash is not None)
 
-        return ahash, vector
+        if values:
+            await db.set_computed_values(values)
+            computed.update({v.sha1: v for v in values})
+            logger.debug(f'computed {len(values)} images')
+        return [computed[t.sha1] for t in tasks if t.sha1 in computed]
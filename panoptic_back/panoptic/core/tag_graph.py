@@ -0,0 +1,109 @@
+from panoptic.models import Tag
+
+
+class TagGraph:
+    """
+    Parent / children links of the tags of a property, loaded once from the tags table.
+    Tags can have several parents, root tags have the parent 0.
+    Ancestor and descendant sets are computed on first use and kept until the graph is invalidated
+    """
+    def __init__(self, tags: list[Tag]):
+        self.tags: dict[int, Tag] = {tag.id: tag for tag in tags}
+        self.children: dict[int, set[int]] = {}
+        for tag in tags:
+            for parent in tag.parents:
+                self.children.setdefault(parent, set()).add(tag.id)
+        self._ancestors: dict[int, frozenset[int]] = {}
+        self._descendants: dict[int, frozenset[int]] = {}
+
+    def ancestors(self, tag_id: int) -> frozenset[int]:
+        """
+        All the tags above this one, through every parent
+        """
+        if tag_id not in self._ancestors:
+            self._ancestors[tag_id] = frozenset(self._walk(tag_id, self._parents))
+        return self._ancestors[tag_id]
+
+    def descendants(self, tag_id: int) -> frozenset[int]:
+        """
+        All the tags below this one, through every child
+        """
+        if tag_id not in self._descendants:
+            self._descendants[tag_id] = frozenset(self._walk(tag_id, self._children))
+        return self._descendants[tag_id]
+
+    def is_ancestor(self, ancestor_id: int, tag_id: int) -> bool:
+        return ancestor_id in self.ancestors(tag_id)
+
+    def creates_cycle(self, tag_id: int, parent_id: int) -> bool:
+        """
+        Whether giving the parent parent_id to the tag would make it one of its own ancestors
+        """
+        if not parent_id:
+            return False
+        return parent_id == tag_id or self.is_ancestor(tag_id, parent_id)
+
+    def orphaned_descendants(self, tag_ids: set[int]) -> list[int]:
+        """
+        Tags left without any parent once tag_ids are deleted, recursively. Parents are visited before their children
+        """
+        deleted = set(tag_ids)
+        res = []
+        to_visit = list(tag_ids)
+        while to_visit:
+            for child in self.children.get(to_visit.pop(), []):
+                if child not in deleted and all(parent in deleted for parent in self.tags[child].parents):
+                    deleted.add(child)
+                    res.append(child)
+                    to_visit.append(child)
+        return res
+
+    def _parents(self, tag_id: int):
+        return self.tags[tag_id].parents if tag_id in self.tags else []
+
+    def _children(self, tag_id: int):
+        return self.children.get(tag_id, [])
+
+    @staticmethod
+    def _walk(tag_id: int, next_tags) -> set[int]:
+        # the root parent 0 isn't a tag, a cycle in the table can't loop forever
+        res = set()
+        to_visit = [tag_id]
+        while to_visit:
+            for tag in next_tags(to_visit.pop()):
+                if tag and tag not in res:
+                    res.add(tag)
+                    to_visit.append(tag)
+        res.discard(tag_id)
+        return res
+
+
+_graphs: dict[int, TagGraph] = {}
+# incremented on each invalidation so that a graph loaded while tags were written isn't kept
+_generation = 0
+
+
+async def get_tag_graph(property_id: int) -> TagGraph:
+    from panoptic.core import db, db_utils
+    # inside a transaction the tags may have changed, the graph is loaded with these changes and not kept
+    if db_utils.in_transaction():
+        return TagGraph(await db.get_tags(property_id))
+    if property_id not in _graphs:
+        generation = _generation
+        graph = TagGraph(await db.get_tags(property_id))
+        if generation != _generation:
+            return graph
+        _graphs[property_id] = graph
+    return _graphs[property_id]
+
+
+def invalidate_tag_graph(property_id: int = None):
+    """
+    Forget the graph of a property after its tags changed, all graphs when the property isn't known
+    """
+    global _generation
+    _generation += 1
+    if property_id is None:
+        _graphs.clear()
+    else:
+        _graphs.pop(property_id, None)
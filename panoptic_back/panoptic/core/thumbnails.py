@@ -0,0 +1,359 @@
+import asyncio
+import io
+import mmap
+import os
+import struct
+
+import numpy as np
+from PIL import Image as PILImage, features
+
+# max number of thumbnails asked in one bundle, the grid asks for the visible tiles and the next ones
+MAX_BUNDLE = 1000
+
+
+class ThumbnailStore:
+    """
+    Thumbnails appended one after the other in a single data file, with an index file of fixed width records
+    (sha1, offset, length) loaded in memory. The data file is memory mapped to read the thumbnails.
+    A thumbnail is only written once: its name is the sha1 of the image so its content can't change.
+    Thumbnails of deleted images are discarded by a record with the TOMBSTONE offset, their data stays in the pack
+    until it is compacted, see compact_stores
+    """
+    SHA1_SIZE = 40
+    RECORD = np.dtype([('sha1', f'S{SHA1_SIZE}'), ('offset', '<u8'), ('length', '<u4')])
+    TOMBSTONE = 2 ** 64 - 1
+
+    def __init__(self, folder: str, name: str = 'thumbnails'):
+        self.folder = folder
+        self.data_file = name + '.pack'
+        self.index_file = name + '.idx'
+        self.size = 0
+        self._index: dict[str, tuple[int, int]] = {}
+        # bytes of the data file that aren't indexed anymore, counted so that compact_stores doesn't have to sum them
+        self._dead_bytes = 0
+        self._map: mmap.mmap | None = None
+        self._load()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.folder, name)
+
+    def _load(self):
+        self._finish_compaction()
+        if not os.path.exists(self._path(self.data_file)):
+            return
+        self.size = os.path.getsize(self._path(self.data_file))
+        if not os.path.exists(self._path(self.index_file)):
+            return
+        nb_records = os.path.getsize(self._path(self.index_file)) // self.RECORD.itemsize
+        records = np.fromfile(self._path(self.index_file), dtype=self.RECORD, count=nb_records)
+        self._index = {}
+        for sha1, offset, length in records.tolist():
+            if offset == self.TOMBSTONE:
+                self._index.pop(sha1.decode(), None)
+            # the thumbnail is written before its record, a record pointing after the end of the data is from a crash
+            elif offset + length <= self.size:
+                self._index[sha1.decode()] = (offset, length)
+        self._dead_bytes = self.size - sum(length for _, length in self._index.values())
+
+    def _finish_compaction(self):
+        """
+        When the compaction was interrupted after the data file was replaced, only the index is left to replace.
+        Otherwise the old files are still complete and the new ones are dropped
+        """
+        data_tmp, index_tmp = self._path(self.data_file) + '.tmp', self._path(self.index_file) + '.tmp'
+        if os.path.exists(index_tmp) and not os.path.exists(data_tmp):
+            os.replace(index_tmp, self._path(self.index_file))
+        [os.remove(path) for path in [data_tmp, index_tmp] if os.path.exists(path)]
+
+    def __contains__(self, sha1: str) -> bool:
+        return sha1 in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def dead_bytes(self) -> int:
+        """
+        Size of the data that isn't indexed anymore, freed by compact
+        """
+        return self._dead_bytes
+
+    def get(self, sha1: str) -> bytes | None:
+        if sha1 not in self._index:
+            return None
+        offset, length = self._index[sha1]
+        if length == 0:
+            return b''
+        data_map = self._map
+        if data_map is None or len(data_map) < offset + length:
+            data_map = self._remap()
+        return data_map[offset:offset + length]
+
+    def get_many(self, sha1s: list[str]) -> list[bytes | None]:
+        return [self.get(sha1) for sha1 in sha1s]
+
+    def put(self, sha1: str, data: bytes):
+        self.put_many([sha1], [data])
+
+    def put_many(self, sha1s: list[str], datas: list[bytes]):
+        self.size = self._append(self._path(self.data_file), self._path(self.index_file), self._index, self.size,
+                                 sha1s, datas)
+
+    def discard(self, sha1s: list[str]):
+        """
+        Forget the thumbnails of deleted images, they can be put again if the image comes back
+        """
+        records = []
+        for sha1 in sha1s:
+            entry = self._index.pop(sha1, None)
+            if entry is not None:
+                records.append((sha1.encode(), self.TOMBSTONE, 0))
+                self._dead_bytes += entry[1]
+        if records:
+            with open(self._path(self.index_file), 'ab') as f:
+                f.write(np.array(records, dtype=self.RECORD).tobytes())
+
+    def compact(self, keep: set[str] | None = None, batch_size: int = 1000):
+        """
+        Rewrite the pack with only the indexed thumbnails, and only the ones of keep when it is given.
+        The new files are written next to the old ones then replace them, batch_size thumbnails at a time
+        """
+        sha1s = [sha1 for sha1 in self._index if keep is None or sha1 in keep]
+        data_tmp, index_tmp = self._path(self.data_file) + '.tmp', self._path(self.index_file) + '.tmp'
+        [open(path, 'wb').close() for path in [data_tmp, index_tmp]]
+        index = {}
+        size = 0
+        for start in range(0, len(sha1s), batch_size):
+            batch = sha1s[start:start + batch_size]
+            size = self._append(data_tmp, index_tmp, index, size, batch, self.get_many(batch))
+        # files can't be replaced while they are mapped on windows
+        self._close_map()
+        os.replace(data_tmp, self._path(self.data_file))
+        os.replace(index_tmp, self._path(self.index_file))
+        self._index, self.size, self._dead_bytes = index, size, 0
+
+    def close(self):
+        self._close_map()
+
+    @classmethod
+    def _append(cls, data_path: str, index_path: str, index: dict, size: int, sha1s: list[str],
+                datas: list[bytes]) -> int:
+        """
+        Append the thumbnails that aren't in the index yet, returns the new size of the data file
+        """
+        records = []
+        with open(data_path, 'ab') as f:
+            for sha1, data in zip(sha1s, datas):
+                if sha1 in index:
+                    continue
+                f.write(data)
+                records.append((sha1.encode(), size, len(data)))
+                index[sha1] = (size, len(data))
+                size += len(data)
+        if records:
+            with open(index_path, 'ab') as f:
+                f.write(np.array(records, dtype=cls.RECORD).tobytes())
+        return size
+
+    def _remap(self) -> mmap.mmap:
+        # the previous map is closed once the threads still reading it are done with it
+        with open(self._path(self.data_file), 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+# packs are compacted when the project is opened once this part of their data isn't indexed anymore
+COMPACT_DEAD_RATIO = 0.25
+COMPACT_MIN_DEAD_BYTES = 64 * 1024 * 1024
+
+# sizes of the pyramid, the small ones are made at import and the larger ones when they are first asked
+TIERS = [128, 256, 512]
+IMPORT_TIERS = [128, 256]
+# tier served in place of the old 200 pixels jpeg thumbnails
+GRID_TIER = 256
+# webp by default, avif is smaller but much slower to encode
+THUMBNAIL_FORMAT = os.getenv('PANOPTIC_THUMBNAIL_FORMAT', 'webp').lower()
+THUMBNAIL_QUALITY = {'avif': 50, 'webp': 50, 'jpeg': 30}
+
+# thumbnails of 200 pixels made before the pyramid, in jpeg
+store: ThumbnailStore | None = None
+tier_stores: dict[int, ThumbnailStore] = {}
+# tiers being made, so that a thumbnail asked several times at once is only made once
+_pending: dict[tuple[str, int], asyncio.Future] = {}
+
+
+def open_store(folder: str) -> ThumbnailStore:
+    global store, tier_stores
+    [s.close() for s in [store, *tier_stores.values()] if s is not None]
+    store = ThumbnailStore(folder)
+    tier_stores = {size: ThumbnailStore(folder, f'thumbnails_{size}') for size in TIERS}
+    return store
+
+
+def compact_stores():
+    """
+    Compact the packs where the thumbnails of deleted images take too much space.
+    Blocking, to run in a thread before the thumbnails are served
+    """
+    for s in [store, *tier_stores.values()]:
+        if s.dead_bytes >= max(COMPACT_MIN_DEAD_BYTES, s.size * COMPACT_DEAD_RATIO):
+            s.compact()
+
+
+def get_store() -> ThumbnailStore:
+    return store
+
+
+def get_tier_store(size: int) -> ThumbnailStore:
+    return tier_stores[size]
+
+
+def discard(sha1s: list[str]):
+    """
+    Forget the thumbnails of all sizes of images that were deleted
+    """
+    [s.discard(sha1s) for s in [store, *tier_stores.values()] if s is not None]
+
+
+def pick_tier(width: int) -> int:
+    """
+    Smallest size at or above the width, the largest size for wider images
+    """
+    return next((size for size in TIERS if size >= width), TIERS[-1])
+
+
+def thumbnail_format() -> str:
+    # the codecs available depend on how Pillow was built
+    if THUMBNAIL_FORMAT in ('avif', 'webp') and features.check(THUMBNAIL_FORMAT):
+        return THUMBNAIL_FORMAT
+    return 'webp' if features.check('webp') else 'jpeg'
+
+
+def make_tiers(image: PILImage.Image, sizes: list[int]) -> dict[int, bytes]:
+    """
+    Encoded thumbnails of the image for each size, each one is reduced from the previous larger one
+    """
+    res = {}
+    image_format = thumbnail_format()
+    for size in sorted(sizes, reverse=True):
+        image = image.copy()
+        image.thumbnail(size=(size, size))
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format, quality=THUMBNAIL_QUALITY[image_format])
+        res[size] = buffer.getvalue()
+    return res
+
+
+def make_tier_from_file(file_path: str, size: int) -> bytes:
+    """
+    Blocking, to run in a thread
+    """
+    with PILImage.open(file_path) as image:
+        # jpeg files are decoded directly at a reduced scale, large originals don't need to be decoded fully
+        image.draft('RGB', (size, size))
+        return make_tiers(image.convert('RGB'), [size])[size]
+
+
+def media_type(data: bytes) -> str:
+    if data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[4:12] in (b'ftypavif', b'ftypavis'):
+        return 'image/avif'
+    return 'image/jpeg'
+
+
+async def get_thumbnail(sha1: str, width: int) -> tuple[bytes | None, int | None]:
+    """
+    Thumbnail of the smallest tier at or above the width, with the size of the tier it comes from.
+    The tiers that aren't made at import are made from the original file the first time they are asked.
+    Smaller tiers are used when the original isn't found, then the old 200 pixels jpeg whose size is None
+    """
+    size = pick_tier(width)
+    data = tier_stores[size].get(sha1)
+    if data is None and size not in IMPORT_TIERS:
+        data = await _make_tier(sha1, size)
+    if data is not None:
+        return data, size
+    smaller = next((s for s in reversed(TIERS) if s < size and sha1 in tier_stores[s]), None)
+    if smaller is not None:
+        return tier_stores[smaller].get(sha1), smaller
+    return store.get(sha1), None
+
+
+async def _make_tier(sha1: str, size: int) -> bytes | None:
+    key = (sha1, size)
+    if key in _pending:
+        return await asyncio.shield(_pending[key])
+    future = asyncio.get_running_loop().create_future()
+    _pending[key] = future
+    try:
+        data = None
+        from panoptic.core import db
+        for file_path in await db.get_image_paths(sha1):
+            try:
+                data = await asyncio.to_thread(make_tier_from_file, file_path, size)
+                break
+            except (OSError, ValueError):
+                continue
+        if data is not None:
+            # the pack is written from the event loop only, never from the threads
+            tier_stores[size].put(sha1, data)
+        future.set_result(data)
+        return data
+    except BaseException:
+        # the requests waiting for it fall back to the smaller tiers
+        future.set_result(None)
+        raise
+    finally:
+        del _pending[key]
+
+
+def mini_path(sha1: str) -> str:
+    return os.path.join(os.environ['PANOPTIC_DATA'], 'mini', sha1 + '.jpeg')
+
+
+def read_mini(sha1: str) -> bytes | None:
+    """
+    Thumbnail of the grid: the jpeg made before the pyramid, the tier that replaced it, or the file of the mini
+    folder for the projects that weren't packed yet.
+    Blocking, to run in a thread
+    """
+    data = store.get(sha1)
+    if data is None:
+        data = tier_stores[GRID_TIER].get(sha1)
+    # sha1s are hexadecimal, anything else could leave the mini folder
+    if data is not None or not sha1.isalnum():
+        return data
+    try:
+        with open(mini_path(sha1), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def read_minis(sha1s: list[str]) -> list[bytes | None]:
+    return [read_mini(sha1) for sha1 in sha1s]
+
+
+def to_bundle(sha1s: list[str], minis: list[bytes | None]) -> bytes:
+    """
+    Length prefixed binary bundle, all integers are little endian:
+        uint32 number of thumbnails
+        for each thumbnail, in the order of the request:
+            uint16 length of the sha1, sha1 in ascii
+            uint32 length of the image, image bytes (length 0 when the thumbnail doesn't exist)
+    """
+    parts = [struct.pack('<I', len(sha1s))]
+    for sha1, data in zip(sha1s, minis):
+        key = sha1.encode()
+        data = data or b''
+        parts.append(struct.pack('<H', len(key)))
+        parts.append(key)
+        parts.append(struct.pack('<I', len(data)))
+        parts.append(data)
+    return b''.join(parts)
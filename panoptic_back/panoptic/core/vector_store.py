@@ -0,0 +1,118 @@
+import json
+import os
+
+import numpy as np
+
+
+class VectorStore:
+    """
+    Image vectors stored outside of SQLite in a contiguous float32 matrix file: the vector of the computed value
+    with id i is the row i of the matrix. The database is the only mapping from sha1s to ids.
+    Rows that were never written are filled with zeros.
+    The matrix is memory mapped so that getting vectors doesn't copy them in memory
+    """
+    MATRIX_FILE = 'vectors.f32'
+    INFO_FILE = 'vectors.json'
+    # sha1s of the rows written by older versions, not used anymore
+    LEGACY_SHA1_FILE = 'vectors.sha1'
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.dim: int | None = None
+        self.nb_rows = 0
+        self._matrix: np.memmap | None = None
+        self._load()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.folder, name)
+
+    def _load(self):
+        if not os.path.exists(self._path(self.INFO_FILE)):
+            return
+        with open(self._path(self.INFO_FILE), 'r') as f:
+            self.dim = json.load(f)['dim']
+        self.nb_rows = os.path.getsize(self._path(self.MATRIX_FILE)) // self._row_size
+        if os.path.exists(self._path(self.LEGACY_SHA1_FILE)):
+            os.remove(self._path(self.LEGACY_SHA1_FILE))
+
+    @property
+    def _row_size(self):
+        return self.dim * np.dtype('float32').itemsize
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """
+        Read only view of all the vectors, rows that were never written are filled with zeros
+        """
+        if self.dim is None or self.nb_rows == 0:
+            return np.empty((0, self.dim or 0), dtype='float32')
+        if self._matrix is None or self._matrix.shape[0] != self.nb_rows:
+            self._matrix = np.memmap(self._path(self.MATRIX_FILE), dtype='float32', mode='r',
+                                     shape=(self.nb_rows, self.dim))
+        return self._matrix
+
+    def has_rows(self, ids: list[int]) -> np.ndarray:
+        """
+        Mask of the ids whose row was written, a vector is never made of zeros only
+        """
+        ids = np.asarray(ids, dtype='int64')
+        res = ids < self.nb_rows
+        if res.any():
+            res[res] = self.get_rows(ids[res]).any(axis=1)
+        return res
+
+    def row(self, id_: int) -> np.ndarray:
+        return self.matrix[id_]
+
+    def get_rows(self, ids: list[int]) -> np.ndarray:
+        return self.matrix[np.asarray(ids, dtype='int64')]
+
+    def write(self, ids: list[int], vectors):
+        if not ids:
+            return
+        vectors = np.asarray(vectors, dtype='float32').reshape(len(ids), -1)
+        if self.dim is None:
+            self._set_dim(vectors.shape[1])
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f'Vector store contains vectors of size {self.dim}, got {vectors.shape[1]}')
+
+        # writing after the end of the file extends it with zeros for the rows in between
+        with open(self._path(self.MATRIX_FILE), 'r+b') as matrix:
+            for id_, vector in zip(ids, vectors):
+                matrix.seek(id_ * self._row_size)
+                matrix.write(vector.tobytes())
+        self.nb_rows = max(self.nb_rows, max(ids) + 1)
+
+    def reset(self, dim: int | None = None):
+        """
+        Empty the store, needed to store vectors of another size.
+        New files replace the old ones so that arrays still mapped on them stay valid
+        """
+        self._matrix = None
+        self.nb_rows = 0
+        self.dim = None
+        if dim is not None:
+            self._set_dim(dim)
+        else:
+            [os.remove(self._path(name)) for name in [self.INFO_FILE, self.MATRIX_FILE]
+             if os.path.exists(self._path(name))]
+
+    def _set_dim(self, dim: int):
+        self.dim = dim
+        open(self._path(self.MATRIX_FILE) + '.tmp', 'wb').close()
+        os.replace(self._path(self.MATRIX_FILE) + '.tmp', self._path(self.MATRIX_FILE))
+        with open(self._path(self.INFO_FILE), 'w') as f:
+            json.dump({'dim': dim}, f)
+
+
+store: VectorStore | None = None
+
+
+def open_store(folder: str) -> VectorStore:
+    global store
+    store = VectorStore(folder)
+    return store
+
+
+def get_store() -> VectorStore:
+    return store
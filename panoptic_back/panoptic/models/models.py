@@ -71,6 +71,22 @@ class Image:
 class ImageImportTask:
     image_path: str
     folder_id: int
+    # (size, mtime, inode) of the file when it was scanned
+    fingerprint: tuple[int, int, int] | None = None
+    # the file was already imported but its content changed
+    replace: bool = False
+
+
+@dataclass(slots=True)
+class DecodedImage:
+    """
+    Result of the import stage handed to the vectorization stage.
+    ahash and pixels are only set when the file was decoded during this import
+    """
+    image_id: int
+    sha1: str
+    ahash: str | None = None
+    pixels: numpy.ndarray | None = None
 
 
 @dataclass(slots=True)
@@ -78,6 +94,8 @@ class ComputedValue:
     sha1: str
     ahash: str
     vector: numpy.ndarray
+    # id of the computed value, used as a stable id in the vector store and the similarity index
+    id: int | None = None
 
 
 class Parameters(BaseModel):
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 from typing import Any
 from fastapi_camelcase import CamelModel
+from pydantic import constr
 from .models import PropertyType, JSON
 
 
@@ -26,6 +27,14 @@ class ExportPropertiesPayload(CamelModel):
     images: list[int] | None
 
 
+# sha1 as produced by hashlib, thumbnails are looked up by their name
+Sha1 = constr(regex=r'^[0-9a-f]{40}$')
+
+
+class GetThumbnailsPayload(CamelModel):
+    sha1s: list[Sha1]
+
+
 class SetPropertyValuePayload(CamelModel):
     property_id: int
     image_ids: list[int] | None
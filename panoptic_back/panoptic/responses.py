@@ -0,0 +1,164 @@
+import os
+import re
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.types import Receive, Scope, Send
+
+# the name of the thumbnails is the sha1 of the image, they never change
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# the originals can be modified on disk, the browser keeps them but asks if they changed before using them
+REVALIDATE = 'no-cache'
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def not_modified(request_headers: Headers, etag: str, modified: int | None = None) -> bool:
+    """
+    Whether the copy of the client is still valid. If-None-Match wins over If-Modified-Since when both are given
+    """
+    if_none_match = request_headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+    if_modified_since = request_headers.get('if-modified-since')
+    if if_modified_since is not None and modified is not None:
+        try:
+            return modified <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+class ImageBytesResponse(Response):
+    """
+    Image already read in memory, with a strong ETag built from its sha1 (and its size for the thumbnails).
+    Answers 304 to conditional requests
+    """
+    def __init__(self, content: bytes, etag: str, cache_control: str = IMMUTABLE, **kwargs):
+        super().__init__(content, headers={'cache-control': cache_control, 'etag': f'"{etag}"'}, **kwargs)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if not_modified(Headers(scope=scope), self.headers['etag']):
+            self.body = b''
+            self.status_code = 304
+            del self.headers['content-type']
+            self.headers['content-length'] = '0'
+        await super().__call__(scope, receive, send)
+
+
+class ImageFileResponse(FileResponse):
+    """
+    Serves an image file with a strong ETag built from its modification date and size, prefixed by its sha1 when it
+    is known. The sha1 is the one of the pixels, the bytes of the file can change without changing it (new metadata,
+    other encoding) so it isn't enough to validate a byte range.
+    Answers 304 to conditional requests and 206 to a single byte range.
+    When the server supports the ASGI zero copy extension the file is given to sendfile, otherwise it is sent by chunks
+    """
+    def __init__(self, path: str, sha1: str | None = None, cache_control: str = REVALIDATE, **kwargs):
+        super().__init__(path, headers={'cache-control': cache_control, 'accept-ranges': 'bytes'}, **kwargs)
+        self.sha1 = sha1
+        self.start = 0
+        self.length = 0
+
+    def set_stat_headers(self, stat_result: os.stat_result):
+        etag = f'{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}'
+        if self.sha1:
+            etag = f'{self.sha1}-{etag}'
+        self.headers.setdefault('last-modified', formatdate(stat_result.st_mtime, usegmt=True))
+        self.headers.setdefault('etag', f'"{etag}"')
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        try:
+            stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+        except FileNotFoundError:
+            await self._send_empty(send, 404)
+            return
+        if not stat.S_ISREG(stat_result.st_mode):
+            await self._send_empty(send, 404)
+            return
+        self.set_stat_headers(stat_result)
+        size = stat_result.st_size
+        request_headers = Headers(scope=scope)
+
+        if not_modified(request_headers, self.headers['etag'], int(stat_result.st_mtime)):
+            # a 304 keeps the validators but has no body
+            del self.headers['content-type']
+            await self._send_empty(send, 304)
+            return
+
+        self.start, self.length = 0, size
+        byte_range = self._requested_range(request_headers, stat_result)
+        if byte_range == 'unsatisfiable':
+            self.headers['content-range'] = f'bytes */{size}'
+            await self._send_empty(send, 416)
+            return
+        if byte_range is not None:
+            self.start, end = byte_range
+            self.length = end - self.start + 1
+            self.status_code = 206
+            self.headers['content-range'] = f'bytes {self.start}-{end}/{size}'
+        self.headers['content-length'] = str(self.length)
+
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if self.send_header_only or self.length == 0:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        elif 'http.response.zerocopysend' in scope.get('extensions', {}):
+            with open(self.path, 'rb') as file:
+                await send({'type': 'http.response.zerocopysend', 'file': file.fileno(), 'offset': self.start,
+                            'count': self.length, 'more_body': False})
+        else:
+            await self._send_chunks(send)
+        if self.background is not None:
+            await self.background()
+
+    async def _send_chunks(self, send: Send):
+        async with await anyio.open_file(self.path, mode='rb') as file:
+            await file.seek(self.start)
+            remaining = self.length
+            while remaining > 0:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    # the file was truncated while it was read
+                    remaining = 0
+                remaining -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+
+    async def _send_empty(self, send: Send, status_code: int):
+        self.headers['content-length'] = '0'
+        await send({'type': 'http.response.start', 'status': status_code, 'headers': self.raw_headers})
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    def _requested_range(self, request_headers: Headers, stat_result: os.stat_result):
+        """
+        The (start, end) bytes asked by the Range header, None to send the whole file.
+        Several ranges aren't supported, the whole file is sent instead
+        """
+        range_header = request_headers.get('range')
+        if range_header is None:
+            return None
+        if_range = request_headers.get('if-range')
+        if if_range is not None and if_range != self.headers['etag'] \
+                and if_range != self.headers['last-modified']:
+            return None
+        match = RANGE_RE.match(range_header.strip())
+        if match is None:
+            return None
+        size = stat_result.st_size
+        first, last = match.groups()
+        if not first and not last:
+            return None
+        if not first:
+            # suffix range, the last bytes of the file
+            if int(last) == 0 or size == 0:
+                return 'unsatisfiable'
+            return max(size - int(last), 0), size - 1
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= size:
+            return 'unsatisfiable'
+        return start, min(int(last), size - 1) if last else size - 1
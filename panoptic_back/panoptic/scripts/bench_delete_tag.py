@@ -0,0 +1,83 @@
+"""
+Benchmark of core.delete_tag on a synthetic tag tree: the root tag is deleted with all its descendants while
+being used by many images. Compares the previous cascade, that saved each property value in its own commit,
+with the bulk deletion done in one transaction
+
+usage: python -m panoptic.scripts.bench_delete_tag [nb_images] [depth] [nb_children]
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from panoptic import core
+from panoptic.core import db, db_utils
+from panoptic.models import PropertyType
+
+
+async def fill_database(nb_images: int, depth: int, nb_children: int) -> int:
+    """
+    Create a tree of tags and tag every image with one leaf and the root, returns the root tag id
+    """
+    prop = await db.add_property('bench', PropertyType.multi_tags.value, 'id')
+    root = await db.add_tag(prop.id, 'root', json.dumps([0]), 'red')
+    level = [root]
+    for d in range(depth):
+        next_level = []
+        for parent in level:
+            for c in range(nb_children):
+                next_level.append(await db.add_tag(prop.id, f'{parent}_{c}', json.dumps([parent]), 'red'))
+        level = next_level
+    folder = await db.add_folder('/bench', 'bench')
+    await db_utils.execute_query_many('INSERT INTO images (folder_id, name, extension, sha1, url, width, height) '
+                                      'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                      [(folder.id, f'image_{i}.jpg', 'jpg', f'sha1{i:036d}', '', 200, 200)
+                                       for i in range(nb_images)])
+    await db.set_multiple_property_values(prop.id, [[root, level[i % len(level)]] for i in range(nb_images)],
+                                          list(range(1, nb_images + 1)))
+    return root
+
+
+async def delete_tag_one_by_one(tag_id: int):
+    await db.delete_tag_by_id(tag_id)
+    for child in await db.get_tags_by_parent_id(tag_id):
+        child.parents.remove(tag_id)
+        if not child.parents:
+            await delete_tag_one_by_one(child.id)
+        else:
+            await db.update_tag(child)
+    for data in await db.get_property_values_with_tag(tag_id):
+        if tag_id in data.value:
+            data.value.remove(tag_id)
+            await db.set_property_values(data.property_id, data.value, image_ids=[data.image_id])
+
+
+async def measure(nb_images: int, depth: int, nb_children: int, delete) -> float:
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.environ['PANOPTIC_DATA'] = data_dir
+        await db_utils.init()
+        try:
+            root = await fill_database(nb_images, depth, nb_children)
+            start = time.perf_counter()
+            await delete(root)
+            duration = time.perf_counter() - start
+            cursor = await db_utils.execute_query("SELECT COUNT(*) FROM image_tags")
+            assert (await cursor.fetchone())[0] == 0
+            return duration
+        finally:
+            await db_utils.close()
+
+
+async def main(nb_images: int, depth: int, nb_children: int):
+    before = await measure(nb_images, depth, nb_children, delete_tag_one_by_one)
+    print(f'one commit per value: {before:.2f}s')
+    after = await measure(nb_images, depth, nb_children, core.delete_tag)
+    print(f'single transaction: {after:.2f}s')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000,
+                     int(sys.argv[2]) if len(sys.argv) > 2 else 3,
+                     int(sys.argv[3]) if len(sys.argv) > 3 else 5))
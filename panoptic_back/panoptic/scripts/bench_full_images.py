@@ -0,0 +1,97 @@
+"""
+Benchmark of core.get_full_images: property values read grouped by image id and by sha1 with only their value
+decoded, against the previous version that decoded every column of the three tables it read and merged them in Python
+
+usage: python -m panoptic.scripts.bench_full_images [nb_images] [nb_properties]
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from panoptic import core
+from panoptic.core import db, db_utils
+from panoptic.models import Image, PropertyValue
+
+
+async def fill_database(nb_images: int, nb_properties: int):
+    folder = await db.add_folder('/bench', 'bench')
+    images = [(folder.id, f'image_{i}.jpg', 'jpg', f'sha1{i:036d}', f'/bench/image_{i}.jpg', 200, 200)
+              for i in range(nb_images)]
+    await db_utils.execute_query_many('INSERT INTO images (folder_id, name, extension, sha1, url, width, height) '
+                                      'VALUES (?, ?, ?, ?, ?, ?, ?)', images)
+    await db_utils.execute_query_many('INSERT INTO computed_values (sha1, ahash) VALUES (?, ?)',
+                                      [(f'sha1{i:036d}', f'{i:016x}') for i in range(nb_images)])
+    for index in range(nb_properties):
+        # half of the properties are bound to the image id, the other half to the sha1
+        mode = 'id' if index % 2 else 'sha1'
+        prop = await db.add_property(f'property_{index}', 'string', mode)
+        if mode == 'id':
+            values = [(prop.id, i + 1, '', json.dumps(f'value {i}')) for i in range(nb_images)]
+        else:
+            values = [(prop.id, -1, f'sha1{i:036d}', json.dumps(f'value {i}')) for i in range(nb_images)]
+        await db_utils.execute_query_many('INSERT INTO property_values (property_id, image_id, sha1, value) '
+                                          'VALUES (?, ?, ?, ?)', values)
+
+
+def baseline_decode(value):
+    try:
+        return json.loads(value)
+    except (TypeError, json.JSONDecodeError, UnicodeDecodeError):
+        return value
+
+
+async def get_full_images_baseline():
+    """
+    get_full_images as it was before the single query path: three full table reads, every column of the property
+    values decoded as json through a dict of the column names, then merged in Python
+    """
+    cursor = await db_utils.execute_query('SELECT * FROM images')
+    images = [Image(*row) for row in await cursor.fetchall()]
+    cursor = await db_utils.execute_query('SELECT * FROM property_values')
+    columns = [c[0] for c in cursor.description]
+    property_values = [PropertyValue(**{key: baseline_decode(value) for key, value in zip(columns, row)})
+                       for row in await cursor.fetchall()]
+    cursor = await db_utils.execute_query('SELECT sha1, ahash FROM computed_values')
+    ahashs = {row[0]: row[1] for row in await cursor.fetchall()}
+    image_index = {img.id: img for img in images}
+    sha1_properties = {}
+    for value in property_values:
+        if value.image_id >= 0:
+            image_index[value.image_id].properties[value.property_id] = value
+        else:
+            sha1_properties.setdefault(value.sha1, []).append(value)
+    for img in images:
+        for value in sha1_properties.get(img.sha1, []):
+            img.properties[value.property_id] = value
+        if img.sha1 in ahashs:
+            img.ahash = ahashs[img.sha1]
+    return images
+
+
+async def measure(get_images) -> float:
+    start = time.perf_counter()
+    images = await get_images()
+    assert all(len(img.properties) for img in images)
+    return time.perf_counter() - start
+
+
+async def main(nb_images: int, nb_properties: int):
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.environ['PANOPTIC_DATA'] = data_dir
+        await db_utils.init()
+        try:
+            await fill_database(nb_images, nb_properties)
+            before = await measure(get_full_images_baseline)
+            print(f'previous version, every column decoded: {before:.2f}s')
+            after = await measure(core.get_full_images)
+            print(f'values grouped by image and by sha1: {after:.2f}s')
+        finally:
+            await db_utils.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+                     int(sys.argv[2]) if len(sys.argv) > 2 else 20))
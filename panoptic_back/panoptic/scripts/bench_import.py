@@ -0,0 +1,59 @@
+"""
+Benchmark of the database side of the image import: images/sec written when each image is inserted with its own
+commit (previous behaviour) and when the import stage writes the rows of a batch of files in one transaction
+
+usage: python -m panoptic.scripts.bench_import [nb_images] [nb_workers] [batch_size]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from panoptic.core import db, db_utils
+
+
+def image_row(folder_id: int, index: int) -> tuple:
+    name = f'image_{index}.jpg'
+    return folder_id, name, 'jpg', f'{index:040d}', f'/images/{name}', 200, 200
+
+
+async def insert_row_by_row(folder_id: int, indexes: list[int]):
+    for index in indexes:
+        await db.add_image(*image_row(folder_id, index))
+
+
+async def insert_batch(folder_id: int, indexes: list[int]):
+    await db.add_images([image_row(folder_id, index) for index in indexes])
+
+
+async def run(insert, folder_path: str, nb_images: int, nb_workers: int, batch_size: int) -> float:
+    folder = await db.add_folder(folder_path, os.path.basename(folder_path))
+    batches = iter([list(range(start, min(start + batch_size, nb_images)))
+                    for start in range(0, nb_images, batch_size)])
+
+    async def worker():
+        for batch in batches:
+            await insert(folder.id, batch)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(nb_workers)])
+    return nb_images / (time.perf_counter() - start)
+
+
+async def main(nb_images: int, nb_workers: int, batch_size: int):
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.environ['PANOPTIC_DATA'] = data_dir
+        await db_utils.init()
+        # both paths get the same number of concurrent workers, like the import stage
+        before = await run(insert_row_by_row, '/bench/row_by_row', nb_images, nb_workers, batch_size)
+        print(f'one commit per image: {before:.0f} images/sec')
+        after = await run(insert_batch, '/bench/batch', nb_images, nb_workers, batch_size)
+        print(f'one transaction per batch of {batch_size}: {after:.0f} images/sec')
+        await db_utils.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000,
+                     int(sys.argv[2]) if len(sys.argv) > 2 else 6,
+                     int(sys.argv[3]) if len(sys.argv) > 3 else 16))
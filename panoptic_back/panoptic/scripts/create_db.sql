@@ -1,4 +1,4 @@
-CREATE TABLE folders(
+CREATE TABLE IF NOT EXISTS folders(
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     path TEXT UNIQUE,
     name TEXT,
@@ -6,20 +6,20 @@ CREATE TABLE folders(
     FOREIGN KEY (parent) REFERENCES folders (id) ON DELETE CASCADE
 );
 
-CREATE TABLE tabs(
+CREATE TABLE IF NOT EXISTS tabs(
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT,
     data JSON
 );
 
-CREATE TABLE properties (
+CREATE TABLE IF NOT EXISTS properties (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT,
     type TEXT,
     mode TEXT DEFAULT 'id'
 );
 
-CREATE TABLE images (
+CREATE TABLE IF NOT EXISTS images (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     folder_id INTEGER NOT NULL,
     name TEXT NOT NULL,
@@ -31,17 +31,24 @@ CREATE TABLE images (
     width INTEGER NOT NULL
 );
 
-CREATE INDEX idx_image_filepath ON images (folder_id, name, extension);
-CREATE INDEX idx_image_sha1 ON images (sha1);
+CREATE INDEX IF NOT EXISTS idx_image_filepath ON images (folder_id, name, extension);
+CREATE INDEX IF NOT EXISTS idx_image_sha1 ON images (sha1);
+CREATE INDEX IF NOT EXISTS idx_image_url ON images (url);
 
 
-CREATE TABLE computed_values (
-    sha1 TEXT PRIMARY KEY,
+-- id is the stable id of the vector in the vector store and the similarity index, unlike an implicit rowid
+-- it isn't renumbered by VACUUM and AUTOINCREMENT never gives it again once deleted
+CREATE TABLE IF NOT EXISTS computed_values (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sha1 TEXT NOT NULL UNIQUE,
     ahash TEXT,
     vector ARRAY
 );
+-- vectors are kept in the vector store, only the ones of old projects are left in the table to be moved there.
+-- The partial index stays empty once they are moved, checking that none are left costs nothing
+CREATE INDEX IF NOT EXISTS idx_computed_values_vector ON computed_values (sha1) WHERE vector IS NOT NULL;
 
-CREATE TABLE property_values (
+CREATE TABLE IF NOT EXISTS property_values (
     property_id INTEGER NOT NULL,
     image_id INTEGER NOT NULL,
     sha1 TEXT INTEGER NOT NULL,
@@ -53,12 +60,77 @@ CREATE TABLE property_values (
     FOREIGN KEY (property_id) REFERENCES properties (id) ON DELETE CASCADE
 );
 
+CREATE INDEX IF NOT EXISTS idx_property_values_image_id ON property_values (image_id);
+CREATE INDEX IF NOT EXISTS idx_property_values_sha1 ON property_values (sha1);
+
 
-CREATE TABLE tags (
+CREATE TABLE IF NOT EXISTS tags (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     property_id INTEGER NOT NULL,
     value TEXT NOT NULL,
     parents JSON,
     color TEXT,
     FOREIGN KEY (property_id) REFERENCES properties (id) ON DELETE CASCADE
-);
\ No newline at end of file
+);
+
+-- one row per tag of each tag / multi_tags property value, kept in sync with property_values by the triggers below
+-- so that the images using a tag are found with the tag_id index instead of scanning the JSON values
+CREATE TABLE IF NOT EXISTS image_tags (
+    property_id INTEGER NOT NULL,
+    image_id INTEGER NOT NULL,
+    sha1 TEXT NOT NULL,
+    tag_id INTEGER NOT NULL,
+    PRIMARY KEY (property_id, image_id, sha1, tag_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_image_tags_tag_id ON image_tags (tag_id);
+
+-- values that aren't JSON arrays give no tag
+CREATE TRIGGER IF NOT EXISTS image_tags_insert AFTER INSERT ON property_values
+WHEN (SELECT type FROM properties WHERE id = NEW.property_id) IN ('tag', 'multi_tags')
+BEGIN
+    INSERT OR IGNORE INTO image_tags (property_id, image_id, sha1, tag_id)
+    SELECT NEW.property_id, NEW.image_id, NEW.sha1, value
+    FROM json_each(CASE WHEN json_valid(NEW.value) THEN CASE json_type(NEW.value) WHEN 'array' THEN NEW.value END END);
+END;
+
+CREATE TRIGGER IF NOT EXISTS image_tags_update AFTER UPDATE OF value ON property_values
+WHEN (SELECT type FROM properties WHERE id = NEW.property_id) IN ('tag', 'multi_tags')
+BEGIN
+    DELETE FROM image_tags WHERE property_id = OLD.property_id AND image_id = OLD.image_id AND sha1 = OLD.sha1;
+    INSERT OR IGNORE INTO image_tags (property_id, image_id, sha1, tag_id)
+    SELECT NEW.property_id, NEW.image_id, NEW.sha1, value
+    FROM json_each(CASE WHEN json_valid(NEW.value) THEN CASE json_type(NEW.value) WHEN 'array' THEN NEW.value END END);
+END;
+
+CREATE TRIGGER IF NOT EXISTS image_tags_delete AFTER DELETE ON property_values
+BEGIN
+    DELETE FROM image_tags WHERE property_id = OLD.property_id AND image_id = OLD.image_id AND sha1 = OLD.sha1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS image_tags_delete_property AFTER DELETE ON properties
+BEGIN
+    DELETE FROM image_tags WHERE property_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS image_tags_update_property AFTER UPDATE OF type ON properties
+WHEN OLD.type != NEW.type
+BEGIN
+    DELETE FROM image_tags WHERE property_id = NEW.id;
+    INSERT OR IGNORE INTO image_tags (property_id, image_id, sha1, tag_id)
+    SELECT pv.property_id, pv.image_id, pv.sha1, j.value
+    FROM property_values pv,
+         json_each(CASE WHEN json_valid(pv.value) THEN CASE json_type(pv.value) WHEN 'array' THEN pv.value END END) j
+    WHERE pv.property_id = NEW.id AND NEW.type IN ('tag', 'multi_tags');
+END;
+
+-- size, modification time and inode of imported files, used to detect changes when a folder is synced again
+CREATE TABLE IF NOT EXISTS image_files (
+    folder_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    extension TEXT NOT NULL,
+    size INTEGER,
+    mtime INTEGER,
+    inode INTEGER,
+    PRIMARY KEY (folder_id, name, extension)
+);
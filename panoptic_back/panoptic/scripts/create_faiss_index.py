@@ -2,17 +2,37 @@ import asyncio
 import logging
 import os
 
-from panoptic.compute.similarity import create_similarity_tree_faiss
+import numpy as np
+
+from panoptic.compute.similarity import create_similarity_tree_faiss, get_similarity_tree_faiss, \
+    update_similarity_tree_faiss
 from panoptic.core import db, db_utils
-from panoptic.models import ComputedValue
+from panoptic.core.vector_store import get_store
 
 logger = logging.getLogger('Create Faiss')
 
 
-async def compute_faiss_index():
+async def compute_faiss_index(force=False):
+    """
+    Add the new vectors to the faiss index and remove the ones of deleted images.
+    The index is only built from scratch when it doesn't exist yet or when it grew or shrank too much
+    """
     logger.info('Start')
-    all_images: list[ComputedValue] = await db.get_sha1_computed_values()
-    create_similarity_tree_faiss(all_images)
+    tree = get_similarity_tree_faiss()
+    ids, sha1s = await db.get_used_computed_ids()
+    if tree is not None and not force:
+        # images removed then restored keep the id of their computed value, a high water mark would skip them
+        missing, removed_ids = tree.diff(ids)
+        added_ids = np.asarray(ids, dtype='int64')[missing].tolist()
+        added_sha1s = [sha1 for sha1, is_missing in zip(sha1s, missing) if is_missing]
+        if not tree.needs_rebuild(len(added_ids), len(removed_ids)):
+            update_similarity_tree_faiss(tree, added_ids, added_sha1s, get_store().get_rows(added_ids), removed_ids)
+            logger.info(f'Updated: {len(added_ids)} added, {len(removed_ids)} removed')
+            return
+    # vectors are read directly from the vector store, rows are indexed by computed value id
+    if not ids:
+        return
+    create_similarity_tree_faiss(ids, sha1s, get_store().get_rows(ids))
     logger.info('Success')
 
 async def start():
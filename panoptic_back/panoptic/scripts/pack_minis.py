@@ -0,0 +1,63 @@
+"""
+Move the thumbnails of the mini folder of projects into their thumbnail pack, then compact the pack and the packs of
+the other thumbnail sizes so that they only keep the thumbnails of the images of the project.
+Panoptic must not be running on these projects.
+Opening a project only compacts the packs holding many discarded thumbnails, this script also drops the thumbnails
+of images deleted before they were discarded
+
+usage: python -m panoptic.scripts.pack_minis [--keep-files] [project_folder ...]
+without folder, the project of PANOPTIC_DATA is packed
+"""
+import argparse
+import os
+import sqlite3
+from contextlib import closing
+
+from tqdm import tqdm
+
+from panoptic.core.thumbnails import ThumbnailStore, TIERS
+
+BATCH_SIZE = 1000
+
+
+def pack_folder(folder: str, keep_files: bool = False):
+    store = ThumbnailStore(folder)
+    mini_folder = os.path.join(folder, 'mini')
+    names = [name for name in os.listdir(mini_folder) if name.endswith('.jpeg')] \
+        if os.path.isdir(mini_folder) else []
+    progress = tqdm(total=len(names), desc=folder)
+    for start in range(0, len(names), BATCH_SIZE):
+        batch = names[start:start + BATCH_SIZE]
+        datas = []
+        for name in batch:
+            with open(os.path.join(mini_folder, name), 'rb') as f:
+                datas.append(f.read())
+        store.put_many([name[:-len('.jpeg')] for name in batch], datas)
+        # the files are only removed once the thumbnails are written in the pack
+        if not keep_files:
+            [os.remove(os.path.join(mini_folder, name)) for name in batch]
+        progress.update(len(batch))
+    progress.close()
+
+    used = None
+    db_path = os.path.join(folder, 'panoptic.db')
+    if os.path.exists(db_path):
+        with closing(sqlite3.connect(db_path)) as conn:
+            used = {row[0] for row in conn.execute('SELECT DISTINCT sha1 FROM images')}
+    store.compact(keep=used)
+    print(f'{folder}: {len(names)} files packed, {len(store)} thumbnails in {store.size / 1e6:.1f}MB')
+    store.close()
+    # the packs of the pyramid are compacted too
+    for size in TIERS:
+        tier_store = ThumbnailStore(folder, f'thumbnails_{size}')
+        tier_store.compact(keep=used)
+        tier_store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('folders', nargs='*')
+    parser.add_argument('--keep-files', action='store_true', help="don't delete the files of the mini folder")
+    args = parser.parse_args()
+    for project in args.folders or [os.environ['PANOPTIC_DATA']]:
+        pack_folder(project, args.keep_files)
@@ -2,10 +2,12 @@ import asyncio
 import os
 import pickle
 
+import numpy as np
 from tqdm import tqdm
 
 from panoptic.compute import create_pca, to_pca, create_similarity_tree, can_compute_pca
 from panoptic.core import db
+from panoptic.core.vector_store import get_store
 from panoptic.models import ComputedValue
 
 
@@ -23,9 +25,10 @@ async def compute_all_pca(force=False):
         print("creating pca")
         create_pca(vectors)
         print("converting vectors")
-        for i, v in tqdm(zip(all_images, vectors)):
-            pca_vec = to_pca(v)
-            await db.set_computed_value(i.sha1, i.ahash, pca_vec)
+        pca_values = [ComputedValue(i.sha1, i.ahash, to_pca(np.array(v))) for i, v in tqdm(zip(all_images, vectors))]
+        # reduced vectors don't have the same size, the vector store has to be emptied before writing them
+        get_store().reset()
+        await db.set_computed_values(pca_values)
     all_images_pca: list[ComputedValue] = await db.get_sha1_computed_values()
     create_similarity_tree(all_images_pca)
     await db.vacuum()